@@ -1,10 +1,12 @@
 import argparse
+import os
 from contextlib import ExitStack
 
 import numpy as np
 import sys
 
 from pyautogramm.activation import feature_activation_rule_extractor
+import pyautogramm.filters
 
 
 if __name__ == "__main__":
@@ -17,20 +19,27 @@ if __name__ == "__main__":
     cmd.add_argument("--dep-filter", type=str, default="", required=False)
     cmd.add_argument("--feature-filter", type=str, default="", required=False)
     cmd.add_argument("--treebank-filter", type=str, default="")
+    cmd.add_argument("--cache-dir", type=str, default="")
+    cmd.add_argument("--jobs", type=int, default=1)
+    cmd.add_argument("--parse-jobs", type=int, default=1)
+    cmd.add_argument("--max-degree", type=int, default=2)
+    cmd.add_argument("--min-feature-occurence", type=int, default=5)
+    cmd.add_argument("--include-neg", action="store_true")
     cmd.add_argument("--alpha-start", type=float, default=0.1)
     cmd.add_argument("--alpha-end", type=float, default=0.001)
     cmd.add_argument("--alpha-num", type=int, default=100)
+    cmd.add_argument("--adaptive-alphas", action="store_true")
+    cmd.add_argument("--max-rules", type=int, default=0)
+    cmd.add_argument("--cprofile", action="store_true")
+    cmd.add_argument("--checkpoint-dir", type=str, default="")
+    cmd.add_argument("--resume", action="store_true")
+    cmd.add_argument("--shards", action="store_true")
     args = cmd.parse_args()
 
-    # constraint on filters
-    # there are hard constraints, i.e. like head_upos=VERB
+    # constraint on filters, e.g. gov.upos=VERB,dep.upos=NOUN|dep.upos=PROPN
+    # see pyautogramm.filters.DependencyFilter for the syntax
     # if the feature is a set, it will be interpreted has mod_children_upos must contains VERB
-    if len(args.dep_filter) > 0:
-        dep_filters = [a.split("=") for a in args.dep_filter.split(",")]
-        assert len(dep_filters) > 0
-        assert all(len(f) == 2 for f in dep_filters)
-    else:
-        dep_filters = []
+    dep_filter = pyautogramm.filters.compile_dependency_filter(args.dep_filter)
 
     # feature names that include these strings will be removed,
     # used for features that can spoilt the prediction.
@@ -41,6 +50,15 @@ if __name__ == "__main__":
     else:
         feature_filter = args.feature_filter.split(",")
 
+    # one checkpoint per treebank, e.g. in output.checkpoints for output.json,
+    # only if asked since all the files of each treebank must be hashed to identify it
+    if len(args.checkpoint_dir) > 0:
+        checkpoint_dir = args.checkpoint_dir
+    elif args.resume:
+        checkpoint_dir = os.path.splitext(args.json)[0] + ".checkpoints"
+    else:
+        checkpoint_dir = None
+
     with ExitStack() as stack:
         if len(args.error) > 0:
             error_stream = stack.enter_context(open(args.error, "w"))
@@ -51,29 +69,27 @@ if __name__ == "__main__":
             args.treebank,
             args.json,
             # dependency filter
-            lambda dep: (
-                dep["gov.rel_synt"] not in ["orphan", "goeswith", "reparandum"]
-                and all(
-                        False
-                        if k not in dep
-                        else (
-                            dep[k] == v if dep[k] == str else v in dep[k]
-                        )
-                        for k, v in dep_filters
-                )
-            ),
+            pyautogramm.filters.default_dependency_filter() & dep_filter,
             # feature filter
-            lambda degree, name: (
-                # if we filter by POS, we need to remove them
-                all(name != k for k, _ in dep_filters)
-                and all(name.lower().find(f) < 0 for f in feature_filter)
-                # use endswith because we don't want to match patterns of the form lemma_UPOS or lemmas_UPOS
-                and (not name.lower().endswith("lemma"))
-                and (not name.lower().endswith("lemmas"))
-            ),
+            pyautogramm.filters.FeatureFilter(dep_filter.feature_names(), feature_filter),
             feature_name=args.feature_name,
             feature_value=args.feature_value,
             alphas=np.linspace(args.alpha_start, args.alpha_end, args.alpha_num),
             treebank_filters=None if len(args.treebank_filter) == 0 else args.treebank_filter.split(","),
+            cache_dir=None if len(args.cache_dir) == 0 else args.cache_dir,
+            jobs=args.jobs,
+            max_degree=args.max_degree,
+            min_feature_occurence=args.min_feature_occurence,
+            include_neg=args.include_neg,
+            adaptive_alphas=args.adaptive_alphas,
+            max_rules=None if args.max_rules <= 0 else args.max_rules,
+            parse_jobs=args.parse_jobs,
+            # resources used by each phase, e.g. output.profile.json for output.json
+            profile_path=os.path.splitext(args.json)[0] + ".profile.json",
+            cprofile=args.cprofile,
+            checkpoint_dir=checkpoint_dir,
+            resume=args.resume,
+            # e.g. output.index.json and output.shards/ for output.json
+            index_path=os.path.splitext(args.json)[0] + ".index.json" if args.shards else None,
             error_stream=error_stream
         )
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+import pyximport
+pyximport.install()
+import pyautogramm.features
+
+import pyautogramm.data
+import pyautogramm.filters
+import pyautogramm.path
+import pyautogramm.profile
+import pyautogramm.scoring
+import pyautogramm.synthetic
+import pyautogramm.table
+
+
+# Benchmark of each stage of the activation pipeline on synthetic treebanks,
+# see pyautogramm.synthetic for the generator and pyautogramm.profile for the measures.
+# Stages are run one after the other (instead of the streamed version used by the extractors)
+# so that reading, dependency extraction and table construction are timed separately.
+def benchmark(path, args, dependency_filter, feature_predicate):
+    profile = pyautogramm.profile.Profile(cprofile=False)
+
+    with profile.phase("read"):
+        sentences = pyautogramm.data.read(path)
+    with profile.phase("extract_dependencies"):
+        deps = pyautogramm.data.extract_dependencies(
+            sentences,
+            split_head_rel=True,
+            add_closed_pos_tags_lemma=True,
+            add_similar_pos_tags=True,
+            predicate=dependency_filter
+        )
+    profile.record("n_sentences", len(sentences))
+    profile.record("n_deps", len(deps))
+    del sentences
+    with profile.phase("build_table"):
+        table = pyautogramm.table.DependencyTable.from_dicts(deps)
+    del deps
+
+    X = None
+    for degree in args.degrees:
+        feature_set = pyautogramm.features.FeatureSet()
+        feature_set.add_feature(pyautogramm.features.AllSingletonFeatures(
+            predicate=lambda name: (feature_predicate(1, name) and name != args.feature_name)
+        ))
+        for d in range(2, degree + 1):
+            feature_set.add_feature(pyautogramm.features.AllProductFeatures(
+                degree=d,
+                min_occurences=args.min_feature_occurence,
+                predicate=lambda name, d=d: (feature_predicate(d, name) and name != args.feature_name)
+            ))
+        with profile.phase("init_features_degree%i" % degree):
+            feature_set.init_from_data(table)
+        with profile.phase("build_features_degree%i" % degree):
+            X_degree = feature_set.build_features(table, sparse=True, collapse=True)
+        profile.record("matrix_degree%i" % degree, {"n_rows": X_degree.shape[0], "n_columns": X_degree.shape[1], "nnz": int(X_degree.nnz)})
+        if degree == args.fit_degree:
+            X, fit_feature_set = X_degree, feature_set
+        del X_degree
+
+    if X is None:
+        return profile
+
+    column = table.column(args.feature_name)
+    y = (column.dense(len(table)) == table.value_to_id(args.feature_value)).astype(np.float64)
+    with profile.phase("unique_rows"):
+        X, y, sample_weights = pyautogramm.features.unique_rows(X, y)
+    profile.record("matrix", {"n_rows": X.shape[0], "n_columns": X.shape[1], "nnz": int(X.nnz)})
+
+    # the solver is compiled by numba on its first fit (for each dtype),
+    # so a tiny problem is fitted first to exclude compilation from the measures
+    warm_up = scipy.sparse.csc_matrix(np.array([[1, 0], [1, 0], [0, 1], [0, 1]], dtype=X.dtype))
+    for _ in pyautogramm.path.grid_path(warm_up, np.array([1., 1., 0., 0.]), [1e-3], sample_weights=np.ones(4)):
+        pass
+
+    # same loop as the extractors, without building the output
+    fits = list()
+    selected = set()
+    alphas = np.linspace(args.alpha_start, args.alpha_end, args.alpha_num)
+    path = pyautogramm.path.grid_path(X, y, alphas, sample_weights=sample_weights, log=fits)
+    for alpha, coef, intercept in profile.iterate("fit", path):
+        columns = [idx for _, idx in fit_feature_set.feature_weights(coef).values() if idx not in selected]
+        selected.update(columns)
+        if len(columns) > 0:
+            with profile.phase("score"):
+                pyautogramm.scoring.score_rules(X, y, sample_weights, columns)
+    profile.record("fits", fits)
+    profile.record("n_rules", len(selected))
+
+    return profile
+
+
+# Print the ratio of the wall time of each stage to the one in the baseline,
+# and return the number of stages that are slower by more than tolerance
+def compare(results, baseline, tolerance):
+    baseline = {result["n_tokens"]: result for result in baseline["results"]}
+    n_regressions = 0
+    for result in results:
+        if result["n_tokens"] not in baseline:
+            continue
+        for phase, stats in result["phases"].items():
+            if phase not in baseline[result["n_tokens"]]["phases"]:
+                continue
+            ratio = stats["wall_time"] / max(baseline[result["n_tokens"]]["phases"][phase]["wall_time"], 1e-9)
+            regression = ratio > 1 + tolerance
+            n_regressions += int(regression)
+            print("%i tokens\t%s\t%.3fs\tx%.2f%s" % (
+                result["n_tokens"], phase, stats["wall_time"], ratio, "\tREGRESSION" if regression else ""
+            ), flush=True)
+    return n_regressions
+
+
+if __name__ == "__main__":
+    cmd = argparse.ArgumentParser()
+    cmd.add_argument("--json", type=str, required=True)
+    cmd.add_argument("--baseline", type=str, default="")
+    cmd.add_argument("--tolerance", type=float, default=0.2)
+    cmd.add_argument("--data-dir", type=str, default="")
+    cmd.add_argument("--sizes", type=str, default="10000,100000,1000000,5000000")
+    cmd.add_argument("--sentence-length", type=int, default=15)
+    cmd.add_argument("--n-features", type=int, default=6)
+    cmd.add_argument("--n-values", type=int, default=3)
+    cmd.add_argument("--n-lemmas", type=int, default=200)
+    cmd.add_argument("--tree-shape", type=str, default="random", choices=pyautogramm.synthetic.TREE_SHAPES)
+    cmd.add_argument("--seed", type=int, default=0)
+    cmd.add_argument("--degrees", type=str, default="2,3")
+    cmd.add_argument("--fit-degree", type=int, default=2)
+    cmd.add_argument("--min-feature-occurence", type=int, default=5)
+    cmd.add_argument("--feature-name", type=str, default="gov.position")
+    cmd.add_argument("--feature-value", type=str, default="before_dep")
+    cmd.add_argument("--alpha-start", type=float, default=0.1)
+    cmd.add_argument("--alpha-end", type=float, default=0.001)
+    cmd.add_argument("--alpha-num", type=int, default=20)
+    args = cmd.parse_args()
+    args.degrees = [int(degree) for degree in args.degrees.split(",")]
+
+    dependency_filter = pyautogramm.filters.default_dependency_filter().require([args.feature_name])
+    feature_predicate = pyautogramm.filters.FeatureFilter(dependency_filter.feature_names(), [])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # generated treebanks are kept in data_dir if given,
+        # they only depend on the generator options so they are reused by later runs
+        data_dir = args.data_dir if len(args.data_dir) > 0 else tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+        results = list()
+        for n_tokens in [int(size) for size in args.sizes.split(",")]:
+            path = os.path.join(data_dir, "synthetic-%i-%i-%i-%i-%i-%s-%i.conllu" % (
+                n_tokens, args.sentence_length, args.n_features, args.n_values, args.n_lemmas, args.tree_shape, args.seed
+            ))
+            if not os.path.exists(path):
+                print("%i tokens:\tgenerating treebank" % n_tokens, flush=True)
+                pyautogramm.synthetic.generate(
+                    path + ".tmp",
+                    max(1, n_tokens // args.sentence_length),
+                    sentence_length=args.sentence_length,
+                    n_features=args.n_features,
+                    n_values=args.n_values,
+                    n_lemmas=args.n_lemmas,
+                    tree_shape=args.tree_shape,
+                    seed=args.seed
+                )
+                os.rename(path + ".tmp", path)
+
+            print("%i tokens:\trunning benchmark" % n_tokens, flush=True)
+            profile = benchmark(path, args, dependency_filter, feature_predicate)
+            results.append({"n_tokens": n_tokens, **profile.to_json()})
+            for phase, stats in profile.phases.items():
+                print("%i tokens:\t%s\t%.3fs\t%.0fMB" % (n_tokens, phase, stats["wall_time"], stats["peak_rss"]), flush=True)
+
+    with open(args.json, "w") as ostream:
+        json.dump({
+            "options": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "data_dir")},
+            "platform": {"python": sys.version, "machine": platform.machine(), "processor": platform.processor()},
+            "results": results
+        }, ostream, indent=1)
+
+    if len(args.baseline) > 0:
+        with open(args.baseline) as istream:
+            baseline = json.load(istream)
+        n_regressions = compare(results, baseline, args.tolerance)
+        if n_regressions > 0:
+            print("%i stages are slower than the baseline" % n_regressions, file=sys.stderr, flush=True)
+            sys.exit(1)
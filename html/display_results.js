@@ -16,6 +16,176 @@ function sigmoid(z) {
       }
   }
   
+// table of the rules of a treebank
+function rules_table(rules) {
+    return $('<table>')
+    .addClass("table mb-0 table-hover")
+    .bootstrapTable({
+        columns: [
+            {
+                title: '#',
+                formatter: function(value, row, index, field)
+                {
+                    return index + 1;
+                },
+            },
+            {
+                title: 'Pattern',
+                field: 'pattern',
+            },
+            {
+                title: 'Occ.',
+                field: 'n_pattern_occurence',
+            },
+            {
+                title: 'Pos.',
+                formatter: function(value, row, index, field)
+                {
+                    return row["n_pattern_positive_occurence"]
+                    + " (" + (100 * row["n_pattern_positive_occurence"] / row["n_pattern_occurence"]).toFixed(2) + "%)"
+                    ;
+                },
+            },
+            {
+                title: 'Neg.',
+                formatter: function(value, row, index, field)
+                {
+                    return row["n_pattern_occurence"] - row["n_pattern_positive_occurence"]
+                    + " (" + (100 * (row["n_pattern_occurence"] - row["n_pattern_positive_occurence"]) / row["n_pattern_occurence"]).toFixed(2) + "%)"
+                    ;
+                },
+            },
+            {
+                title: 'Decision',
+                field: 'decision',
+            },
+            {
+                title: 'alpha',
+                field: 'alpha',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(5);
+                },
+            },
+            {
+                title: 'weight',
+                field: 'value',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(5);
+                },
+            },
+            {
+                title: 'coverage',
+                field: 'coverage',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+            {
+                title: 'prevision',
+                field: 'precision',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+            {
+                title: 'delta',
+                field: 'delta',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+            {
+                title: 'g-statistics',
+                field: 'g-statistic',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+            {
+                title: 'p-value',
+                field: 'p-value',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+            {
+                title: 'cramers_phi',
+                field: 'cramers_phi',
+                formatter: function(value, row, index, field)
+                {
+                    return value.toFixed(2);
+                },
+            },
+        ],
+        data: rules
+    });
+}
+
+// shards are compact (see pyautogramm/shards.py):
+// fields of the rules are given once and each rule is the list of its values
+function shard_rules(shard) {
+    return shard['rules'].map(function (values) {
+        var rule = {};
+        for (var k = 0; k < shard['fields'].length; k++)
+        {
+            rule[shard['fields'][k]] = values[k];
+        }
+        return rule;
+    });
+}
+
+// url of a shard, given relatively to the index
+function shard_url(index_url, shard) {
+    return index_url.substring(0, index_url.lastIndexOf('/') + 1) + shard;
+}
+
+// show/hide the rules of a treebank (in the row after the clicked one),
+// if the results are an index, the shard is loaded the first time the rules are shown.
+// Clicks are ignored while the shard is loading (pending is the request),
+// and if the request fails an error is shown in the row and the next click retries.
+function toggle_rules(index_url, treebank_data) {
+    var loaded = treebank_data.hasOwnProperty('rules');
+    var pending = null;
+    return function () {
+        var row = $(this).next();
+        if (loaded)
+        {
+            row.toggle();
+            return;
+        }
+        if (pending !== null)
+            return;
+        pending = $.ajax({
+            type: 'GET',
+            url: shard_url(index_url, treebank_data['shard']),
+            dataType: 'json'
+        });
+        pending.done(function (shard) {
+            loaded = true;
+            row.find('> td').empty().append(rules_table(shard_rules(shard)));
+            row.show();
+        });
+        pending.fail(function (e) {
+            console.log("There was an error with your request...");
+            console.log("error: " + JSON.stringify(e));
+            row.find('> td').empty().append(
+                $('<p>').text("Could not load the rules (" + e.status + " " + e.statusText + "), click to retry.")
+            );
+            row.show();
+        });
+        pending.always(function () {
+            pending = null;
+        });
+    };
+}
+
 function load_results(url, text) {
     return function ()
     {
@@ -54,14 +224,14 @@ function load_results(url, text) {
                             )
                             .append(
                                 $('<td>')
-                                .text('show/hide')
+                                .text(
+                                    data[treebank_id].hasOwnProperty('shard')
+                                    ? 'show/hide (' + data[treebank_id]['n_rules'] + ' rules)'
+                                    : 'show/hide'
+                                )
                             )
                             .css('cursor', 'pointer')
-                            .click(
-                                function () {
-                                    $(this).next().toggle();
-                                }
-                            )
+                            .click(toggle_rules(url, data[treebank_id]))
                         )
                         .append(
                             $('<tr>')
@@ -69,115 +239,13 @@ function load_results(url, text) {
                             .append(
                                 $('<td>')
                                 .attr('colspan', '5')
+                                // the output of the extractors contains the rules,
+                                // an index only contains the url of the shard of each treebank,
+                                // which is loaded when the treebank is displayed (see toggle_rules)
                                 .append(
-                                    $('<table>')
-                                    .addClass("table mb-0 table-hover")
-                                    .bootstrapTable({
-                                        columns: [
-                                            {
-                                                title: '#',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return index + 1;
-                                                },
-                                            },
-                                            {
-                                                title: 'Pattern',
-                                                field: 'pattern',
-                                            },
-                                            {
-                                                title: 'Occ.',
-                                                field: 'n_pattern_occurence',
-                                            },
-                                            {
-                                                title: 'Pos.',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return row["n_pattern_positive_occurence"]
-                                                    + " (" + (100 * row["n_pattern_positive_occurence"] / row["n_pattern_occurence"]).toFixed(2) + "%)"
-                                                    ;
-                                                },
-                                            },
-                                            {
-                                                title: 'Neg.',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return row["n_pattern_occurence"] - row["n_pattern_positive_occurence"]
-                                                    + " (" + (100 * (row["n_pattern_occurence"] - row["n_pattern_positive_occurence"]) / row["n_pattern_occurence"]).toFixed(2) + "%)"
-                                                    ;
-                                                },
-                                            },
-                                            {
-                                                title: 'Decision',
-                                                field: 'decision',
-                                            },
-                                            {
-                                                title: 'alpha',
-                                                field: 'alpha',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(5);
-                                                },
-                                            },
-                                            {
-                                                title: 'weight',
-                                                field: 'value',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(5);
-                                                },
-                                            },
-                                            {
-                                                title: 'coverage',
-                                                field: 'coverage',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                            {
-                                                title: 'prevision',
-                                                field: 'precision',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                            {
-                                                title: 'delta',
-                                                field: 'delta',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                            {
-                                                title: 'g-statistics',
-                                                field: 'g-statistic',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                            {
-                                                title: 'p-value',
-                                                field: 'p-value',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                            {
-                                                title: 'cramers_phi',
-                                                field: 'cramers_phi',
-                                                formatter: function(value, row, index, field)
-                                                {
-                                                    return value.toFixed(2);
-                                                },
-                                            },
-                                        ],
-                                        data: data[treebank_id]['rules']
-                                    })
+                                    data[treebank_id].hasOwnProperty('rules')
+                                    ? rules_table(data[treebank_id]['rules'])
+                                    : null
                                 )
                             )
                         );
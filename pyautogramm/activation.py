@@ -1,4 +1,5 @@
 import collections
+import functools
 import os
 import sys
 import glob
@@ -7,19 +8,27 @@ import json
 import numpy as np
 from scipy.stats import chisquare
 import scipy
-import skglm
 
 import pyximport
 pyximport.install()
 import pyautogramm.features
 
 import pyautogramm.data
+import pyautogramm.cache
+import pyautogramm.table
+import pyautogramm.parallel
+import pyautogramm.filters
+import pyautogramm.path
+import pyautogramm.scoring
+import pyautogramm.profile
+import pyautogramm.shards
 import time
 
 
-def feature_activation_rule_extractor(
-        sud_path,
-        output_path,
+def feature_activation_treebank(
+        treebank_path,
+        i,
+        n_treebanks,
         dependency_predicate,
         feature_predicate,
         feature_name,
@@ -27,161 +36,294 @@ def feature_activation_rule_extractor(
         alphas,
         max_degree=2,
         min_feature_occurence=5,
-        treebank_filters=None,
-        error_stream=sys.stderr
+        include_neg=False,
+        adaptive_alphas=False,
+        max_rules=None,
+        cache_dir=None,
+        parse_jobs=1,
+        cprofile=False
 ):
-    treebank_paths = glob.glob(os.path.join(sud_path, "*"))
+    # resources used by each phase, see pyautogramm.profile
+    profile = pyautogramm.profile.Profile(cprofile=cprofile)
+    treebank_name = os.path.basename(treebank_path)
 
-    # filter
-    if treebank_filters is not None:
-        treebank_paths = [path for path in treebank_paths if any(path.find(f) > 0 for f in treebank_filters)]
+    # find all conllu files for treebank,
+    # sorted so that rows of X do not depend on the file system
+    conllu_paths = sorted(glob.glob(os.path.join(treebank_path, "*.conllu")))
+    if len(conllu_paths) == 0:
+        raise pyautogramm.parallel.SkipTreebank("Skipping treebank %s because there is no conllu file!" % treebank_name)
 
-    extracted_data = dict()
-    for i, treebank_path in enumerate(treebank_paths):
-        treebank_name = os.path.basename(treebank_path)
-
-        # find all conllu files for treebank
-        conllu_paths = glob.glob(os.path.join(treebank_path, "*.conllu"))
-        if len(conllu_paths) == 0:
-            print("Skipping treebank %s because there is no conllu file!" % treebank_name, file=error_stream, flush=True)
-            continue
-
-        output_pre = "%s\t(%i / %i):\t" % (treebank_name, i+1, len(treebank_paths))
-
-        # Read data
-        print("%s%s" % (output_pre, "reading data"), flush=True)
-        deps = list()
-        for conllu_path in conllu_paths:
-            data = pyautogramm.data.read(conllu_path)
-            deps.extend(
-                pyautogramm.data.extract_dependencies(
-                    data,
+    output_pre = "%s\t(%i / %i):\t" % (treebank_name, i+1, n_treebanks)
+
+    dependency_filter = pyautogramm.filters.as_dependency_filter(dependency_predicate).require([feature_name])
+
+    feature_set = pyautogramm.features.FeatureSet()
+    feature_set.add_feature(pyautogramm.features.AllSingletonFeatures(
+        include_neg=include_neg,
+        predicate=lambda name: (feature_predicate(1, name) and name != feature_name)
+    ))
+    for degree in range(2, max_degree + 1):
+        feature_set.add_feature(pyautogramm.features.AllProductFeatures(
+            degree=degree,
+            min_occurences=min_feature_occurence,
+            include_neg=include_neg,
+            predicate=lambda name, degree=degree: (feature_predicate(degree, name) and name != feature_name)
+        ))
+
+    # X and y only depend on the treebank, the filters, the feature templates and the targets,
+    # so they can be reused when only alphas change
+    matrix_path = None
+    if cache_dir is not None:
+        matrix_path = pyautogramm.cache.matrix_entry_path(
+            cache_dir,
+            conllu_paths,
+            dependency_filter,
+            feature_predicate,
+            task="activation",
+            feature_name=feature_name,
+            feature_value=feature_value,
+            max_degree=max_degree,
+            min_feature_occurence=min_feature_occurence,
+            include_neg=include_neg
+        )
+
+    if matrix_path is not None and os.path.exists(matrix_path):
+        print("%s%s" % (output_pre, "loading features from cache"), flush=True)
+        with profile.phase("load_matrix"):
+            X, y, sample_weights, info = pyautogramm.cache.load_matrix(matrix_path, feature_set)
+        filtered_deps_len = info["filtered_deps_len"]
+    else:
+        # Read and filter data:
+        # the filter is checked during extraction when possible,
+        # and filtered dependencies are stored in a columnar table
+        print("%s%s" % (output_pre, "reading and filtering dependencies"), flush=True)
+        # features that are not used by any feature template nor by the filter are not built,
+        # this is possible only if we know which features are used by the filter
+        if dependency_filter.feature_names() is None:
+            projection = None
+        else:
+            projection = pyautogramm.filters.FeatureProjection(feature_predicate, max_degree, dependency_filter.feature_names())
+        # dependencies are extracted while sentences are read, so both are in this phase
+        with profile.phase("read"):
+            n_deps = 0
+            tables = list()
+            for conllu_path in conllu_paths:
+                table, n = pyautogramm.cache.cached_table(
+                    conllu_path,
+                    cache_dir=cache_dir,
+                    jobs=parse_jobs,
+                    predicate=dependency_filter,
+                    features=projection,
                     split_head_rel=True,
                     add_closed_pos_tags_lemma=True,
                     add_similar_pos_tags=True
                 )
-            )
-
-        # filter deps
-        print("%s%s" % (output_pre, "filtering dependencies"), flush=True)
-        filtered_deps = list()
-        for dep in deps:
-            if dependency_predicate(dep) and feature_name in dep:
-                filtered_deps.append(dep)
+                n_deps += n
+                tables.append(table)
+            filtered_deps = pyautogramm.table.DependencyTable.concatenate(tables)
 
         if len(filtered_deps) == 0:
-            print("Skipping treebank %s because there is no dependency to analyse!" % treebank_name, file=error_stream, flush=True)
-            continue
+            raise pyautogramm.parallel.SkipTreebank("Skipping treebank %s because there is no dependency to analyse!" % treebank_name)
 
-        print("%s%s" % (output_pre, "Number of dependencies after filtering: %i / %i" % (len(filtered_deps), len(deps))), flush=True)
+        print("%s%s" % (output_pre, "Number of dependencies after filtering: %i / %i" % (len(filtered_deps), n_deps)), flush=True)
 
         # extract features
         print("%s%s" % (output_pre, "extracting features"), flush=True)
-        feature_set = pyautogramm.features.FeatureSet()
-
-        feature_set.add_feature(pyautogramm.features.AllSingletonFeatures(
-            predicate=lambda name: (feature_predicate(1, name) and name != feature_name)
-        ))
-        for degree in range(2, max_degree + 1):
-            feature_set.add_feature(pyautogramm.features.AllProductFeatures(
-                degree=degree,
-                min_occurences=min_feature_occurence,
-                predicate=lambda name, degree=degree: (feature_predicate(degree, name) and name != feature_name)
-            ))
-
         try:
-            feature_set.init_from_data(filtered_deps)
-            X = feature_set.build_features(filtered_deps, sparse=True)
+            with profile.phase("init_features"):
+                feature_set.init_from_data(filtered_deps)
+            # identical columns are merged, other names are kept as aliases of the rule
+            with profile.phase("build_features"):
+                X = feature_set.build_features(filtered_deps, sparse=True, collapse=True)
             if X.shape[1] == 0:
-                print("Skipping treebank %s because there is no extracted feature!" % treebank_name, file=error_stream, flush=True)
-                continue
+                raise pyautogramm.parallel.SkipTreebank("Skipping treebank %s because there is no extracted feature!" % treebank_name)
+        except pyautogramm.features.TooManyProductFeatures as e:
+            raise pyautogramm.parallel.SkipTreebank("Skipping treebank %s: %s" % (treebank_name, e))
         except RuntimeError:
-            print("Skipping treebank %s because there is no extracted feature!" % treebank_name, file=error_stream, flush=True)
-            continue
+            raise pyautogramm.parallel.SkipTreebank("Skipping treebank %s because there is no extracted feature!" % treebank_name)
 
         # build targets
-        y = np.empty((len(filtered_deps),))
-        for i, dep in enumerate(filtered_deps):
-            assert type(dep[feature_name]) == str
-            y[i] = 1 if dep[feature_name] == feature_value else 0
+        column = filtered_deps.column(feature_name)
+        assert not column.is_set
+        y = (column.dense(len(filtered_deps)) == filtered_deps.value_to_id(feature_value)).astype(np.float64)
 
         filtered_deps_len = len(filtered_deps)
-        n_yes = int(y.sum())
-        extracted_data[treebank_name] = dict()
-        extracted_data[treebank_name]["filtered_deps_len"] = filtered_deps_len
-        extracted_data[treebank_name]["n_yes"] = n_yes
-        extracted_data[treebank_name]["intercepts"] = list()
+        profile.record("n_deps", n_deps)
+        profile.record("n_features", X.shape[1])
+        # dependencies with identical features and target are merged,
+        # each unique row is weighted by its number of occurences
+        with profile.phase("unique_rows"):
+            X, y, sample_weights = pyautogramm.features.unique_rows(X, y)
+        if matrix_path is not None:
+            with profile.phase("save_matrix"):
+                pyautogramm.cache.save_matrix(cache_dir, matrix_path, X, y, sample_weights, feature_set, {"filtered_deps_len": filtered_deps_len})
+
+    n_yes = int((sample_weights * y).sum())
+    treebank_data = dict()
+    treebank_data["filtered_deps_len"] = filtered_deps_len
+    treebank_data["n_yes"] = n_yes
+    treebank_data["intercepts"] = list()
 
-        # extract rules
-        all_rules = set()
-        ordered_rules = list()
+    # extract rules
+    all_rules = set()
+    ordered_rules = list()
 
-        for j, alpha in enumerate(alphas):
+    # Alphas are a regularization path, see pyautogramm.path:
+    # either the given (decreasing) grid,
+    # or an adaptive path from the largest useful alpha down to min(alphas)
+    # that only fits where the set of selected features changes
+    fits = list()
+    if adaptive_alphas:
+        path = pyautogramm.path.adaptive_path(X, y, min(alphas), sample_weights=sample_weights, log=fits)
+    else:
+        path = pyautogramm.path.grid_path(X, y, alphas, sample_weights=sample_weights, log=fits)
+    for j, (alpha, coef, intercept) in enumerate(profile.iterate("fit", path)):
+        if adaptive_alphas:
+            print("%s%s" % (output_pre, "extracting rules (alpha = %g)" % alpha), flush=True)
+        else:
             print("%s%s" % (output_pre, "extracting rules (%i / %i)" % (j+1, len(alphas))), flush=True)
-            model = skglm.SparseLogisticRegression(
-                alpha=alpha,
-                fit_intercept=True,
-                max_iter=20,
-                max_epochs=1000,
-            )
-            model.fit(X, y)
-            extracted_data[treebank_name]["intercepts"].append((alpha, model.intercept_))
-
-            for name, (value, idx) in feature_set.feature_weights(model.coef_[0]).items():
-                if name not in all_rules:
-                    all_rules.add(name)
-                    col = np.asarray(X[:, idx].todense())
-                    idx_col = col.squeeze(1)
-
-                    with_feature_selector = idx_col > 0
-                    without_feature_selector = np.logical_not(with_feature_selector)
-
-                    matched = y[with_feature_selector]
-                    n_matched = len(matched)
-                    n_pattern_positive_occurence = matched.sum()
-                    n_pattern_negative_occurence = n_matched - n_pattern_positive_occurence
-
-                    mu = (n_yes/filtered_deps_len)
-                    a = (n_pattern_positive_occurence/n_matched)
-                    gstat =  2 * n_matched * (
-                            ( (a * np.log(a)) if a > 0 else 0) - a * np.log(mu)
-                            + ( ((1 - a) * np.log(1 - a)) if (1 - a) > 0 else 0) - (1 - a) * np.log(1 - mu)
-                            )
-                    p_value = 1 - scipy.stats.chi2.cdf(gstat,1)
-                    cramers_phi = np.sqrt((gstat/n_matched))
-
-                    expected = (n_matched*n_yes) / filtered_deps_len
-                    delta_observed_expected = n_pattern_positive_occurence - expected
-
-                    if n_pattern_positive_occurence/n_matched > int(y.sum())/filtered_deps_len:
-                        decision = 'yes'
-                        coverage = (n_pattern_positive_occurence/n_yes)*100
-                        presicion = (n_pattern_positive_occurence/n_matched)*100
-                    else:
-                        decision = 'no'
-                        coverage = (n_pattern_negative_occurence/(filtered_deps_len - n_yes))*100
-                        presicion = (n_pattern_negative_occurence/n_matched)*100
-                    
-                    ordered_rules.append({
-                        "pattern": ",".join(sorted(name.split(","))),
-                        "n_pattern_occurence": idx_col.sum(),
-                        "n_pattern_positive_occurence": n_pattern_positive_occurence,
-                        "decision": decision,
-                        "alpha": alpha,
-                        "value": value,
-                        "coverage": coverage,
-                        "precision": presicion,
-                        "delta": delta_observed_expected,
-                        "g-statistic": gstat,
-                        "p-value": p_value,
-                        "cramers_phi": cramers_phi
-                    })
-
-        extracted_data[treebank_name]["rules"] = ordered_rules
-        
-        #if len(extracted_data) == 3:
-        #    break
+        treebank_data["intercepts"].append((alpha, intercept))
+
+        # rules of the features selected for the first time, scored in one pass
+        new_rules = [
+            (name, value, idx)
+            for name, (value, idx) in feature_set.feature_weights(coef).items()
+            if name not in all_rules
+        ]
+        # at most max_rules rules in total,
+        # if more rules enter at this alpha, the ones with the largest weights are kept
+        if max_rules is not None and len(new_rules) > max_rules - len(all_rules):
+            largest = np.argsort([-abs(value) for _, value, _ in new_rules], kind="stable")[:max_rules - len(all_rules)]
+            new_rules = [new_rules[k] for k in sorted(largest.tolist())]
+        if len(new_rules) > 0:
+            with profile.phase("score"):
+                scores = pyautogramm.scoring.score_rules(X, y, sample_weights, [idx for _, _, idx in new_rules])
+                # the pattern selects the target if it is more frequent in matched dependencies than overall
+                yes = scores["positive_rate"] > n_yes / filtered_deps_len
+                coverage, precision = pyautogramm.scoring.coverage_precision(scores, yes, n_yes, filtered_deps_len)
+
+        for k, (name, value, idx) in enumerate(new_rules):
+            all_rules.add(name)
+            ordered_rules.append({
+                "pattern": ",".join(sorted(name.split(","))),
+                "aliases": [",".join(sorted(alias.split(","))) for alias in feature_set.feature_aliases(idx)],
+                "n_pattern_occurence": scores["n_pattern_occurence"][k],
+                "n_pattern_positive_occurence": scores["n_pattern_positive_occurence"][k],
+                "decision": "yes" if yes[k] else "no",
+                "alpha": alpha,
+                "value": value,
+                "coverage": coverage[k],
+                "precision": precision[k],
+                "delta": scores["delta"][k],
+                "g-statistic": scores["g-statistic"][k],
+                "p-value": scores["p-value"][k],
+                "cramers_phi": scores["cramers_phi"][k]
+            })
+
+        if max_rules is not None and len(all_rules) >= max_rules:
+            break
+
+    treebank_data["rules"] = ordered_rules
+
+    # matrix after merging identical rows, and summary of each solver fit
+    profile.record("filtered_deps_len", filtered_deps_len)
+    profile.record("matrix", {"n_rows": X.shape[0], "n_columns": X.shape[1], "nnz": int(X.nnz)})
+    profile.record("fits", fits)
+    profile.finish()
+
+    return treebank_data, profile
+
+
+def feature_activation_rule_extractor(
+        sud_path,
+        output_path,
+        dependency_predicate,
+        feature_predicate,
+        feature_name,
+        feature_value,
+        alphas,
+        max_degree=2,
+        min_feature_occurence=5,
+        include_neg=False,
+        adaptive_alphas=False,
+        max_rules=None,
+        treebank_filters=None,
+        cache_dir=None,
+        jobs=1,
+        parse_jobs=1,
+        profile_path=None,
+        cprofile=False,
+        checkpoint_dir=None,
+        resume=False,
+        index_path=None,
+        error_stream=sys.stderr
+):
+    treebank_paths = glob.glob(os.path.join(sud_path, "*"))
+
+    # filter
+    if treebank_filters is not None:
+        treebank_paths = [path for path in treebank_paths if any(path.find(f) > 0 for f in treebank_filters)]
+
+    # the result of each treebank is saved in a checkpoint as soon as it is finished,
+    # and if resume, treebanks already finished with the same query are loaded instead,
+    # parameters that do not change the result (cache, jobs, profiling) are not part of the query
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = functools.partial(
+            pyautogramm.cache.checkpoint_path,
+            checkpoint_dir,
+            dependency_filter=dependency_predicate,
+            feature_filter=feature_predicate,
+            task="activation",
+            feature_name=feature_name,
+            feature_value=feature_value,
+            alphas=[float(alpha) for alpha in alphas],
+            max_degree=max_degree,
+            min_feature_occurence=min_feature_occurence,
+            include_neg=include_neg,
+            adaptive_alphas=adaptive_alphas,
+            max_rules=max_rules
+        )
+
+    # each treebank is processed independently,
+    # in parallel if jobs > 1
+    extracted_data = dict()
+    profiles = dict()
+    for treebank_path, result, error in pyautogramm.parallel.map_treebanks(
+            feature_activation_treebank,
+            treebank_paths,
+            jobs=jobs,
+            checkpoint=checkpoint,
+            resume=resume,
+            dependency_predicate=dependency_predicate,
+            feature_predicate=feature_predicate,
+            feature_name=feature_name,
+            feature_value=feature_value,
+            alphas=alphas,
+            max_degree=max_degree,
+            min_feature_occurence=min_feature_occurence,
+            include_neg=include_neg,
+            adaptive_alphas=adaptive_alphas,
+            max_rules=max_rules,
+            cache_dir=cache_dir,
+            parse_jobs=parse_jobs,
+            cprofile=cprofile
+    ):
+        if result is None:
+            print(error, file=error_stream, flush=True)
+        else:
+            treebank_data, profile = result
+            extracted_data[os.path.basename(treebank_path)] = treebank_data
+            if profile is not None:
+                profiles[os.path.basename(treebank_path)] = profile
 
     print("Done.", flush=True)
     with open(output_path, 'w') as out_stream:
         json.dump(extracted_data, out_stream)
+
+    # summary of each treebank and one file of rules per treebank, for the html dashboard
+    if index_path is not None:
+        pyautogramm.shards.save_shards(index_path, extracted_data)
+
+    if profile_path is not None:
+        pyautogramm.profile.save_profiles(profile_path, profiles)
@@ -0,0 +1,286 @@
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+import pyautogramm.data
+import pyautogramm.filters
+import pyautogramm.table
+
+
+# increase this number each time the binary format changes,
+# so that old cache entries are ignored
+CACHE_VERSION = 2
+# same for feature matrices, it must also be increased
+# each time the features (or their order) change
+MATRIX_CACHE_VERSION = 4
+# same for checkpoints, it must also be increased
+# each time the output of a treebank changes
+CHECKPOINT_VERSION = 5
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# hashes already computed in this process, keyed by (path, size, modification time),
+# since the same files are hashed for parsed tables, matrices and checkpoints
+_file_hashes = dict()
+
+
+def file_hash(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        _file_hashes[key] = _compute_file_hash(path)
+    return _file_hashes[key]
+
+
+def _compute_file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as istream:
+        while True:
+            block = istream.read(HASH_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+# A cache entry is identified by the content of the conllu file
+# and the options given to extract_dependencies,
+# so when a new treebank release is used, only modified files are parsed again.
+def cache_entry_path(cache_dir, path, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False):
+    flags = "v%i-%i%i%i" % (
+        CACHE_VERSION,
+        int(split_head_rel),
+        int(add_closed_pos_tags_lemma),
+        int(add_similar_pos_tags)
+    )
+    return os.path.join(cache_dir, "%s-%s" % (file_hash(path), flags))
+
+
+# Write an entry in a temporary directory first and then rename it,
+# so that a crash (or a concurrent run) never leaves a partial entry.
+# save(directory) must create the directory.
+def _write_entry(cache_dir, entry_path, save):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        save(os.path.join(tmp_dir, "entry"))
+        try:
+            os.rename(os.path.join(tmp_dir, "entry"), entry_path)
+        except OSError:
+            # entry created in the meantime by another process
+            if not os.path.exists(entry_path):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# minimum size of a chunk when a file is parsed in parallel
+MIN_CHUNK_SIZE = 1 << 24
+
+
+# Returns a table with dependencies that satisfy the predicate (all if None),
+# and the total number of dependencies
+def parse_table(path, start=0, end=None, predicate=None, features=None, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False):
+    n_deps = 0
+
+    def count(sentences):
+        nonlocal n_deps
+        for sentence in sentences:
+            n_deps += sum(1 for w in sentence if w["head"] != 0)
+            yield sentence
+
+    builder = pyautogramm.table.DependencyTableBuilder()
+    for dep in pyautogramm.data.iter_dependencies(
+        count(pyautogramm.data.iter_read(path, start=start, end=end)),
+        split_head_rel=split_head_rel,
+        add_closed_pos_tags_lemma=add_closed_pos_tags_lemma,
+        add_similar_pos_tags=add_similar_pos_tags,
+        predicate=predicate,
+        features=features
+    ):
+        builder.add(dep)
+    return builder.build(), n_deps
+
+
+def _parse_chunk(args):
+    path, start, end, predicate, features, flags = args
+    return parse_table(path, start=start, end=end, predicate=predicate, features=features, **flags)
+
+
+def _parse(path, jobs, predicate, features, flags):
+    n_chunks = min(jobs, -(-os.path.getsize(path) // MIN_CHUNK_SIZE))
+    if n_chunks > 1:
+        chunks = pyautogramm.data.sentence_chunks(path, n_chunks)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            # results are gathered in the order of the chunks
+            results = list(executor.map(
+                _parse_chunk,
+                [(path, start, end, predicate, features, flags) for start, end in chunks]
+            ))
+        return (
+            pyautogramm.table.DependencyTable.concatenate([table for table, _ in results]),
+            sum(n_deps for _, n_deps in results)
+        )
+    else:
+        return parse_table(path, predicate=predicate, features=features, **flags)
+
+
+# Load the dependencies of a conllu file as a DependencyTable.
+# Returns the table of dependencies that satisfy the predicate (all if None),
+# and the total number of dependencies in the file.
+# If features is given, only features whose name satisfies it are kept.
+#
+# If cache_dir is None, the file is simply parsed and the predicate
+# is checked during extraction, so rejected dependencies are never fully built,
+# and unused features are not built at all.
+# Otherwise the table of all dependencies (with all features) is read from the cache if possible,
+# or the file is parsed and the result stored in the cache,
+# and then the predicate and the projection are applied on the table.
+#
+# If jobs > 1, large files are split on sentence boundaries
+# and chunks are parsed in worker processes,
+# in this case the predicate must be picklable.
+def cached_table(path, cache_dir=None, jobs=1, predicate=None, features=None, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False):
+    flags = dict(
+        split_head_rel=split_head_rel,
+        add_closed_pos_tags_lemma=add_closed_pos_tags_lemma,
+        add_similar_pos_tags=add_similar_pos_tags
+    )
+    if cache_dir is None:
+        return _parse(path, jobs, predicate, features, flags)
+
+    entry_path = cache_entry_path(cache_dir, path, **flags)
+    if os.path.exists(entry_path):
+        table = pyautogramm.table.load_table(entry_path)
+    else:
+        table, _ = _parse(path, jobs, None, None, flags)
+        _write_entry(cache_dir, entry_path, lambda directory: pyautogramm.table.save_table(table, directory))
+
+    n_deps = len(table)
+    if predicate is not None:
+        table = table.select(pyautogramm.filters.as_dependency_filter(predicate).mask(table))
+    if features is not None:
+        table = table.project(features)
+    return table, n_deps
+
+
+# Hash of a query on the conllu files of a treebank:
+# their content, the filters and other parameters, which must be serializable in json.
+# Returns None if the query cannot be identified,
+# i.e. if a filter is an arbitrary callable.
+def _query_hash(version, paths, dependency_filter, feature_filter, params):
+    dependency_filter = pyautogramm.filters.as_dependency_filter(dependency_filter)
+    if dependency_filter.feature_names() is None or not isinstance(feature_filter, pyautogramm.filters.FeatureFilter):
+        return None
+    h = hashlib.sha1()
+    h.update(version)
+    for path in sorted(paths):
+        h.update(file_hash(path).encode("ascii"))
+    h.update(json.dumps(
+        dict(params, dependency_filter=str(dependency_filter), feature_filter=str(feature_filter)),
+        sort_keys=True
+    ).encode("utf-8"))
+    return h.hexdigest()
+
+
+# A feature matrix entry is identified by the content of all the conllu files of a treebank
+# and by the parameters used to build X and y (filters, feature templates and targets).
+# Returns None if the matrix cannot be cached.
+def matrix_entry_path(cache_dir, paths, dependency_filter, feature_filter, **params):
+    h = _query_hash(b"v%i" % MATRIX_CACHE_VERSION, paths, dependency_filter, feature_filter, params)
+    if h is None:
+        return None
+    return os.path.join(cache_dir, "matrix-%s" % h)
+
+
+# A checkpoint is the result of a treebank for a query,
+# identified like matrix entries but with all the parameters of the query (alphas, thresholds...),
+# so that a run can be resumed after a crash without processing finished treebanks again.
+# Returns None if the result cannot be checkpointed.
+def checkpoint_path(checkpoint_dir, treebank_path, dependency_filter, feature_filter, **params):
+    paths = glob.glob(os.path.join(treebank_path, "*.conllu"))
+    h = _query_hash(b"c%i" % CHECKPOINT_VERSION, paths, dependency_filter, feature_filter, params)
+    if h is None:
+        return None
+    return os.path.join(checkpoint_dir, "%s-%s.json" % (os.path.basename(treebank_path), h))
+
+
+# data is the json-serializable result of the treebank,
+# or None if it was skipped and error is the reason.
+# profile is the json of the profile of the treebank if any (see pyautogramm.profile.Profile.to_json),
+# so that the profiles of resumed treebanks are not lost.
+# The file is written under a temporary name and then renamed,
+# so a crash never leaves a partial checkpoint.
+def save_checkpoint(path, data, error=None, profile=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as ostream:
+            json.dump({"data": data, "error": error, "profile": profile}, ostream)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Returns data, error and profile, see save_checkpoint
+def load_checkpoint(path):
+    with open(path, encoding="utf-8") as istream:
+        checkpoint = json.load(istream)
+    return checkpoint["data"], checkpoint["error"], checkpoint["profile"]
+
+
+# Save X (CSC), y, sample weights and the feature names of feature_set (see FeatureSet.build_features),
+# arrays are stored as .npy files so they can be memory-mapped.
+# Groups of identical columns are concatenated,
+# group k is group_indices[group_offsets[k]:group_offsets[k+1]].
+# info is any json-serializable dict, e.g. statistics of the filtered dependencies.
+def save_matrix(cache_dir, entry_path, X, y, sample_weights, feature_set, info):
+    def save(directory):
+        os.makedirs(directory)
+        if feature_set.groups is None:
+            groups = [np.array([j]) for j in range(X.shape[1])]
+        else:
+            groups = feature_set.groups
+        group_offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+        np.cumsum([len(group) for group in groups], out=group_offsets[1:])
+        group_indices = np.concatenate(groups).astype(np.int64) if len(groups) > 0 else np.zeros(0, dtype=np.int64)
+        for name, array in [
+            ("data", X.data), ("indices", X.indices), ("indptr", X.indptr), ("y", y), ("sample_weights", sample_weights),
+            ("group_indices", group_indices), ("group_offsets", group_offsets)
+        ]:
+            np.save(os.path.join(directory, "%s.npy" % name), array)
+        with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as ostream:
+            json.dump({"shape": list(X.shape), "names": feature_set.names, "info": info}, ostream)
+
+    _write_entry(cache_dir, entry_path, save)
+
+
+# Returns X, y, sample weights and info,
+# and restores the feature names of feature_set so that its feature_weights can be used
+def load_matrix(entry_path, feature_set):
+    with open(os.path.join(entry_path, "vocab.json"), encoding="utf-8") as istream:
+        vocab = json.load(istream)
+    arrays = {
+        name: np.load(os.path.join(entry_path, "%s.npy" % name), mmap_mode="r")
+        for name in ["data", "indices", "indptr", "y", "sample_weights", "group_indices", "group_offsets"]
+    }
+    X = scipy.sparse.csc_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(vocab["shape"]),
+        copy=False
+    )
+    group_offsets = np.asarray(arrays["group_offsets"])
+    group_indices = np.asarray(arrays["group_indices"])
+    feature_set.names = vocab["names"]
+    feature_set.groups = np.split(group_indices, group_offsets[1:-1])
+    feature_set.columns = group_indices[group_offsets[:-1]]
+    return X, np.asarray(arrays["y"]), np.asarray(arrays["sample_weights"]), vocab["info"]
@@ -1,4 +1,5 @@
 import collections
+import os
 
 
 CLOSED_POS_TAGS = {
@@ -34,14 +35,31 @@ SIMILAR_POS_TAGS = [
 ]
 
 
-def read(path):
-    data = list()
-    with open(path) as istream:
-        need_new = True
+# buffer size used when streaming conllu files,
+# large treebanks are read sequentially so a big buffer reduces syscalls
+READ_BUFFER_SIZE = 1 << 20
+
+
+def iter_read(path, buffer_size=READ_BUFFER_SIZE, start=0, end=None):
+    # generator version of read:
+    # yield one sentence at a time so that memory usage
+    # only depends on the sentence length, not on the corpus size.
+    # If start and end are given, only the byte range [start, end) is read,
+    # they must be sentence boundaries (see sentence_chunks)
+    with open(path, "rb", buffering=buffer_size) as istream:
+        istream.seek(start)
+        position = start
+        sentence = list()
         for line in istream:
-            line = line.strip()
+            if end is not None and position >= end:
+                break
+            position += len(line)
+
+            line = line.decode("utf-8").strip()
             if len(line) == 0:
-                need_new = True
+                if len(sentence) > 0:
+                    yield sentence
+                    sentence = list()
                 continue
             if line[0] == "#":
                 continue
@@ -50,10 +68,6 @@ def read(path):
             if line[0].find(".") >= 0 or line[0].find("-") >= 0:
                 continue
 
-            if need_new:
-                data.append(list())
-                need_new = False
-
             if line[5] != "_":
                 feats = {
                     k: v for k, v in [m.split("=") for m in line[5].split("|")]
@@ -61,8 +75,8 @@ def read(path):
             else:
                 feats = dict()
 
-            data[-1].append({
-                "idx": len(data[-1]) + 1,
+            sentence.append({
+                "idx": len(sentence) + 1,
                 "lemma": line[2],
                 "upos": line[3],
                 "head": int(line[6]),
@@ -70,7 +84,41 @@ def read(path):
                 "feats": feats
             })
 
-    return data
+        if len(sentence) > 0:
+            yield sentence
+
+
+def read(path):
+    return list(iter_read(path))
+
+
+# Split a conllu file in (at most) n_chunks byte ranges of similar size,
+# each range starting after an empty line so that sentences are never split.
+def sentence_chunks(path, n_chunks):
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as istream:
+        for k in range(1, n_chunks):
+            position = (size * k) // n_chunks
+            if position <= boundaries[-1]:
+                continue
+            istream.seek(position)
+            # skip the (possibly partial) current line,
+            # and then everything until an empty line
+            istream.readline()
+            while True:
+                line = istream.readline()
+                if len(line) == 0 or len(line.strip()) == 0:
+                    break
+            if istream.tell() >= size:
+                break
+            boundaries.append(istream.tell())
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+# all the possible suffixes of relation features
+RELATION_SUFFIXES = ("_synt", "_deep", "")
 
 
 # split head rel 1:2@3 in two different case:
@@ -94,9 +142,98 @@ def do_split_head_rel(head_rel, split_head_rel=True):
     return ret
 
 
-def extract_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False):
-    dependencies = list()
+# features of a set of words (children of the modifier or of the head),
+# each feature is a set of values.
+# If features is given, only features whose name satisfies it are built.
+def add_children_features(dep, prefix, words, rels, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False, features=None):
+    if features is None:
+        features = lambda name: True
+    want_lemmas = features(prefix + ".lemmas")
+    want_upos = features(prefix + ".upos")
+    want_lemmas_by_upos = add_closed_pos_tags_lemma and any(features(prefix + ".lemmas_" + tag) for tag in CLOSED_POS_TAGS)
+    want_in_upos = add_similar_pos_tags and features(prefix + ".in_upos")
+    # relation suffixes are the same for all words, see do_split_head_rel
+    rel_names = [prefix + ".rels" + k for k in RELATION_SUFFIXES]
+    want_rels = any(features(name) for name in rel_names)
+
+    lemmas = set()
+    upos = set()
+    lemmas_by_upos = collections.defaultdict(lambda: set())
+    words_rels = collections.defaultdict(lambda: set())
+    feats = collections.defaultdict(lambda: set())
+    for w in words:
+        if want_lemmas:
+            lemmas.add(w["lemma"])
+        upos.add(w["upos"])
+        if want_lemmas_by_upos:
+            lemmas_by_upos[w["upos"]].add(w["lemma"])
+        if want_rels:
+            for k, v in rels[w["idx"]].items():
+                words_rels[k].add(v)
+        for k, v in w["feats"].items():
+            if features(prefix + ".%s" % k):
+                feats[k].add(v)
+
+    if want_lemmas:
+        dep[prefix + ".lemmas"] = lemmas
+    if want_upos:
+        dep[prefix + ".upos"] = upos
+    if want_lemmas_by_upos:
+        for tag in CLOSED_POS_TAGS:
+            if tag in upos and features(prefix + ".lemmas_" + tag):
+                assert len(lemmas_by_upos[tag]) > 0
+                dep[prefix + ".lemmas_" + tag] = lemmas_by_upos[tag]
+    if want_in_upos:
+        for tags in SIMILAR_POS_TAGS:
+            if len(upos.intersection(tags)) > 1:
+                dep[prefix + ".in_upos"] = "|".join(tags)
+    for k, v in words_rels.items():
+        if features(prefix + ".rels" + k):
+            dep[prefix + ".rels" + k] = v
+    for k, v in feats.items():
+        dep[prefix + ".%s" % k] = v
+
+
+def extract_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False, predicate=None, features=None):
+    return list(iter_dependencies(
+        data,
+        split_head_rel=split_head_rel,
+        add_closed_pos_tags_lemma=add_closed_pos_tags_lemma,
+        add_similar_pos_tags=add_similar_pos_tags,
+        predicate=predicate,
+        features=features
+    ))
+
+
+# features built from the children of the modifier and of the head,
+# they are the most expensive ones
+CHILDREN_FEATURE_PREFIXES = ("grandchildren.", "siblings.")
+
+
+# data can be any iterable over sentences, e.g. the output of iter_read,
+# in which case sentences are parsed lazily while dependencies are consumed.
+# If predicate is given, only dependencies that satisfy it are returned.
+# If the predicate has a feature_names method (see filters.DependencyFilter)
+# and does not use children features, it is checked before these features are built.
+# If features is given, it is a predicate on feature names (see filters.FeatureProjection)
+# and other features are not built, it must accept all features used by predicate.
+def iter_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=False, add_similar_pos_tags=False, predicate=None, features=None):
+    early_predicate = False
+    if predicate is not None and hasattr(predicate, "feature_names"):
+        names = predicate.feature_names()
+        early_predicate = names is not None and not any(name.startswith(CHILDREN_FEATURE_PREFIXES) for name in names)
+
     for sentence in data:
+        # index built once per sentence:
+        # children[i] is the list of words whose head is i (0 is the root),
+        # so that children features of each dependency are built in linear time
+        # instead of re-scanning the full sentence
+        children = [list() for _ in range(len(sentence) + 1)]
+        for w in sentence:
+            children[w["head"]].append(w)
+        # relations split once per word, indexed by word idx
+        rels = [None] + [do_split_head_rel(w["dep.rel"], split_head_rel=split_head_rel) for w in sentence]
+
         for mod in sentence:
             # not sure if this is a good idea...
             if mod["head"] == 0:
@@ -104,9 +241,7 @@ def extract_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=Fa
 
             mod_idx = mod["idx"]
             mod_head = mod["head"]
-            mod_children = [w for w in sentence if w["head"] == mod_idx]
             head = sentence[mod_head - 1]
-            head_children = [w for w in sentence if w["head"] == mod_head and w["idx"] != mod_idx]
 
             dep = {
                 "dep.lemma": mod["lemma"],
@@ -132,9 +267,9 @@ def extract_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=Fa
                     if head["upos"] in tags:
                         dep["gov.in_upos"] = tags_str
 
-            for k, v in do_split_head_rel(mod["dep.rel"], split_head_rel=split_head_rel).items():
+            for k, v in rels[mod_idx].items():
                 dep["dep.rel" + k] = v
-            for k, v in do_split_head_rel(head["dep.rel"], split_head_rel=split_head_rel).items():
+            for k, v in rels[mod_head].items():
                 dep["gov.rel" + k] = v
 
             for k, v in mod["feats"].items():
@@ -157,63 +292,30 @@ def extract_dependencies(data, split_head_rel=True, add_closed_pos_tags_lemma=Fa
                 # dep["head_is_root"] = "true"
                 pass
 
+            if features is not None:
+                for k in [k for k in dep if not features(k)]:
+                    del dep[k]
+
+            if early_predicate and not predicate(dep):
+                continue
+
             # children of the modifier
-            dep["grandchildren.lemmas"] = set(w["lemma"] for w in mod_children)
-            mod_children_upos = set(w["upos"] for w in mod_children)
-            dep["grandchildren.upos"] = mod_children_upos
-            if add_closed_pos_tags_lemma:
-                for upos in CLOSED_POS_TAGS:
-                    if upos in mod_children_upos:
-                        lemmas = set(w["lemma"] for w in mod_children if w["upos"] == upos)
-                        assert len(lemmas) > 0
-                        dep["grandchildren.lemmas_" + upos] = lemmas
-            if add_similar_pos_tags:
-                for tags in SIMILAR_POS_TAGS:
-                    if len(mod_children_upos.intersection(tags)) > 1:
-                        tags_str = "|".join(tags)
-                        dep["grandchildren.in_upos"] = tags_str
-            mod_children_rels = collections.defaultdict(lambda: set())
-            for w in mod_children:
-                for k, v in do_split_head_rel(w["dep.rel"], split_head_rel=split_head_rel).items():
-                    mod_children_rels[k].add(v)
-            for k, v in mod_children_rels.items():
-                dep["grandchildren.rels" + k] = v
-            feats = collections.defaultdict(lambda: set())
-            for child in mod_children:
-                for k, v in child["feats"].items():
-                    feats[k].add(v)
-            for k, v in feats.items():
-                dep["grandchildren.%s" % k] = v
+            add_children_features(
+                dep, "grandchildren", children[mod_idx], rels,
+                add_closed_pos_tags_lemma=add_closed_pos_tags_lemma,
+                add_similar_pos_tags=add_similar_pos_tags,
+                features=features
+            )
 
             # children of the head
-            dep["siblings.lemmas"] = set(w["lemma"] for w in head_children if w["idx"] != mod_idx)
-            head_children_upos = set(w["upos"] for w in head_children if w["idx"] != mod_idx)
-            dep["siblings.upos"] = head_children_upos
-            if add_closed_pos_tags_lemma:
-                for upos in CLOSED_POS_TAGS:
-                    if upos in head_children_upos:
-                        lemmas = set(w["lemma"] for w in head_children if w["idx"] != mod_idx and w["upos"] == upos)
-                        assert len(lemmas) > 0
-                        dep["siblings.lemmas_" + upos] = lemmas
-            if add_similar_pos_tags:
-                for tags in SIMILAR_POS_TAGS:
-                    if len(head_children_upos.intersection(tags)) > 1:
-                        tags_str = "|".join(tags)
-                        dep["siblings.in_upos"] = tags_str
-            head_children_rels = collections.defaultdict(lambda: set())
-            for w in head_children:
-                for k, v in do_split_head_rel(w["dep.rel"], split_head_rel=split_head_rel).items():
-                    head_children_rels[k].add(v)
-            for k, v in head_children_rels.items():
-                dep["siblings.rels" + k] = v
-            feats = collections.defaultdict(lambda: set())
-            for child in head_children:
-                if child["idx"] != mod_idx:
-                    for k, v in child["feats"].items():
-                        feats[k].add(v)
-            for k, v in feats.items():
-                dep["siblings.%s" % k] = v
-
-            dependencies.append(dep)
-
-    return dependencies
+            add_children_features(
+                dep, "siblings", [w for w in children[mod_head] if w["idx"] != mod_idx], rels,
+                add_closed_pos_tags_lemma=add_closed_pos_tags_lemma,
+                add_similar_pos_tags=add_similar_pos_tags,
+                features=features
+            )
+
+            if predicate is not None and not early_predicate and not predicate(dep):
+                continue
+
+            yield dep
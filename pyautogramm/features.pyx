@@ -1,9 +1,9 @@
 import itertools
-import collections
 import numpy as np
 import scipy.sparse
 
 from pyautogramm.utils import Dict
+from pyautogramm.table import as_table
 
 
 # Should not be used,
@@ -14,7 +14,7 @@ class InterceptFeature:
     def __init__(self):
         self.initialized = True
 
-    def init_from_data(self, data):
+    def init_from_data(self, data, keys=None):
         pass
 
     def build_features(self, X, data, offset):
@@ -27,32 +27,245 @@ class InterceptFeature:
         return 1
 
 
+# number of itemsets whose extensions are counted at once when mining product features
+ITEMSET_BLOCK_SIZE = 4096
+
+# maximum number of product features of a degree,
+# above it mining stops with TooManyProductFeatures instead of running out of memory
+MAX_PRODUCT_FEATURES = 5000000
+
+
+class TooManyProductFeatures(RuntimeError):
+    pass
+
+
+# Sparse matrix builder used in place of a scipy sparse matrix by feature classes:
+# assignments X[rows, cols] = value append (row, column, value) triplets
+# to int32 buffers that grow geometrically,
+# and build() assembles them directly into a CSC matrix.
+# Each entry must be assigned only once.
+class SparseMatrixBuilder:
+    def __init__(self, shape, dtype=np.float32, capacity=1024):
+        self.shape = shape
+        self.dtype = dtype
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.cols = np.empty(capacity, dtype=np.int32)
+        self.data = np.empty(capacity, dtype=dtype)
+        self.nnz = 0
+
+    def __setitem__(self, key, value):
+        rows, cols = key
+        if isinstance(rows, slice):
+            rows = np.arange(self.shape[0])[rows]
+        rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+        n = rows.size
+        if self.nnz + n > len(self.rows):
+            capacity = max(2 * len(self.rows), self.nnz + n)
+            for name in ("rows", "cols", "data"):
+                old = getattr(self, name)
+                new = np.empty(capacity, dtype=old.dtype)
+                new[:self.nnz] = old[:self.nnz]
+                setattr(self, name, new)
+        self.rows[self.nnz:self.nnz + n] = rows.reshape(-1)
+        self.cols[self.nnz:self.nnz + n] = cols.reshape(-1)
+        self.data[self.nnz:self.nnz + n] = value
+        self.nnz += n
+
+    def build(self):
+        rows = self.rows[:self.nnz]
+        cols = self.cols[:self.nnz]
+        order = np.lexsort((rows, cols))
+        indptr = np.zeros(self.shape[1] + 1, dtype=np.int32)
+        np.cumsum(np.bincount(cols, minlength=self.shape[1]), out=indptr[1:])
+        return scipy.sparse.csc_matrix(
+            (self.data[:self.nnz][order], rows[order], indptr),
+            shape=self.shape
+        )
+
+
+# Entries (row, literal) of negated literals of a column:
+# literal_ids is the literal of each value of the column (-1 if it is not used),
+# and each of the n_literals literals occurs in all the rows where the feature is present,
+# except those where the column contains the corresponding value.
+# The complement is built one literal at a time from the sorted rows of the column,
+# so memory only depends on the number of entries.
+# Entries are sorted by literal, and then by row.
+def complement_entries(column, literal_ids, n_literals):
+    all_rows = np.asarray(column.rows)
+    entry_rows = column.entry_rows()
+    used = np.flatnonzero(literal_ids >= 0)
+    # rows of the positive value of each literal, grouped by literal
+    order = used[np.argsort(literal_ids[used], kind="stable")]
+    bounds = np.searchsorted(literal_ids[order], np.arange(n_literals + 1))
+    rows = list()
+    cols = list()
+    for literal in range(n_literals):
+        literal_rows = np.setdiff1d(all_rows, entry_rows[order[bounds[literal]:bounds[literal + 1]]], assume_unique=True)
+        rows.append(literal_rows)
+        cols.append(np.full(len(literal_rows), literal, dtype=np.int64))
+    if n_literals == 0:
+        return all_rows[:0], np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+# Binary matrix with one column per literal, i.e. per pair (feature name, value),
+# for the given features.
+# If include_neg, there is also one negated literal per pair, i.e. name!=value,
+# which is the complement of the positive literal within the rows where the feature is present.
+# Literals that occur in less than min_occurences rows are ignored.
+# Returns the matrix in CSC format, the index in names of the feature of each literal,
+# the table value id of each literal and whether each literal is negated.
+# Literals are sorted by feature, in the order of names,
+# and positive literals of a feature come before its negated literals.
+def literal_matrix(table, names, min_occurences=1, include_neg=False):
+    blocks = list()
+    literal_names = list()
+    literal_values = list()
+    literal_negated = list()
+    for i, name in enumerate(names):
+        column = table.column(name)
+        value_ids, inverse, counts = np.unique(column.values, return_inverse=True, return_counts=True)
+        # drop infrequent literals before counting products:
+        # a product cannot be more frequent than any of its factors
+        frequent = counts >= min_occurences
+        literal_ids = np.full(len(value_ids), -1, dtype=np.int64)
+        literal_ids[frequent] = np.arange(frequent.sum())
+        literal_ids = literal_ids[inverse.reshape(-1)]
+        positive = scipy.sparse.csc_matrix(
+            (
+                np.ones((literal_ids >= 0).sum(), dtype=np.int32),
+                (column.entry_rows()[literal_ids >= 0], literal_ids[literal_ids >= 0])
+            ),
+            shape=(len(table), frequent.sum())
+        )
+        blocks.append(positive)
+        literal_names.append(np.full(frequent.sum(), i, dtype=np.int64))
+        literal_values.append(value_ids[frequent])
+        literal_negated.append(np.zeros(frequent.sum(), dtype=bool))
+
+        if include_neg:
+            # a set value appears at most once in a row,
+            # so a negated literal occurs in all the rows of the feature but those of its positive literal
+            frequent = len(column) - counts >= min_occurences
+            literal_ids = np.full(len(value_ids), -1, dtype=np.int64)
+            literal_ids[frequent] = np.arange(frequent.sum())
+            rows, cols = complement_entries(column, literal_ids[inverse.reshape(-1)], frequent.sum())
+            indptr = np.zeros(frequent.sum() + 1, dtype=np.int64)
+            np.cumsum(np.bincount(cols, minlength=frequent.sum()), out=indptr[1:])
+            blocks.append(scipy.sparse.csc_matrix(
+                (np.ones(len(rows), dtype=np.int32), rows, indptr),
+                shape=(len(table), frequent.sum())
+            ))
+            literal_names.append(np.full(frequent.sum(), i, dtype=np.int64))
+            literal_values.append(value_ids[frequent])
+            literal_negated.append(np.ones(frequent.sum(), dtype=bool))
+
+    if sum(block.shape[1] for block in blocks) == 0:
+        return (
+            scipy.sparse.csc_matrix((len(table), 0), dtype=np.int32),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=bool)
+        )
+    X = scipy.sparse.hstack(blocks, format="csc", dtype=np.int32)
+    return X, np.concatenate(literal_names), np.concatenate(literal_values), np.concatenate(literal_negated)
+
+
+# Binary matrix with one column per literal (name, negated, value) of literals,
+# e.g. the literals of product features found by literal_matrix on other data.
+# A positive literal whose value does not occur in table is empty,
+# and a negated one is active in all the rows where the feature is present.
+def literal_columns(table, literals):
+    by_name = dict()
+    for i, (name, negated, _) in enumerate(literals):
+        by_name.setdefault((name, negated), list()).append(i)
+    rows = [np.zeros(0, dtype=np.int64)]
+    cols = [np.zeros(0, dtype=np.int64)]
+    for (name, negated), indices in by_name.items():
+        if name not in table:
+            continue
+        column = table.column(name)
+        # map value ids of the table to the literals of the column
+        value_map = np.full(len(table.values) + 1, -1, dtype=np.int64)
+        for j, i in enumerate(indices):
+            value_id = table.value_to_id(literals[i][2])
+            if value_id >= 0:
+                value_map[value_id] = j
+        literal_ids = value_map[column.values]
+        if negated:
+            literal_rows, literal_ids = complement_entries(column, literal_ids, len(indices))
+        else:
+            literal_rows = column.entry_rows()[literal_ids >= 0]
+            literal_ids = literal_ids[literal_ids >= 0]
+        rows.append(literal_rows.astype(np.int64))
+        cols.append(np.asarray(indices, dtype=np.int64)[literal_ids])
+    rows = np.concatenate(rows)
+    return scipy.sparse.csc_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, np.concatenate(cols))),
+        shape=(len(table), len(literals))
+    )
+
+
+# Whether each itemset of items (of size k, sorted literal ids) occurs less often
+# than all its subsets of size k-1, given the itemsets of size k-1 and their counts.
+# A subset that is not in prev_items has also been pruned, so the itemset is not kept either.
+# Itemsets are looked up by their key in base n_literals,
+# if keys do not fit in 64 bits, only the checks made while counting are used (see _count_frequent).
+def smaller_than_subsets(items, counts, prev_items, prev_counts, n_literals):
+    keep = np.ones(len(items), dtype=bool)
+    k = items.shape[1]
+    if len(items) == 0 or n_literals ** (k - 1) >= 2 ** 63:
+        return keep
+    powers = n_literals ** np.arange(k - 2, -1, -1, dtype=np.int64)
+    prev_keys = prev_items @ powers
+    order = np.argsort(prev_keys)
+    prev_keys = prev_keys[order]
+    prev_counts = prev_counts[order]
+    for p in range(k - 1):
+        keys = np.delete(items, p, axis=1) @ powers
+        i = np.minimum(np.searchsorted(prev_keys, keys), len(prev_keys) - 1)
+        keep &= (prev_keys[i] == keys) & (counts < prev_counts[i])
+    return keep
+
+
+# If neg, the feature has one column name!=value per value,
+# which is active in all the rows where the feature is present but does not have this value
 class ClassFeature:
-    def __init__(self, name):
+    is_set = False
+
+    def __init__(self, name, neg=False):
         self.name = name
         self.initialized = False
+        self.neg = neg
 
-    def init_from_data(self, data):
-        values = set()
-        for dep in data:
-            if self.name in dep:
-                v = dep[self.name]
-                assert type(v) == str
-                values.add(v)
+    def init_from_data(self, data, keys=None):
+        column = data.column(self.name)
+        assert column.is_set == self.is_set
+        values = set(data.values[v] for v in np.unique(column.values))
         if len(values) == 0:
             raise RuntimeError("No value found for feature")
         self.dict = Dict(values)
         self.initialized = True
 
     def build_features(self, X, data, offset):
-        for i, dep in enumerate(data):
-            if self.name in dep:
-                value = dep[self.name]
-                value_id = self.dict.str_to_id(value)
-                X[i, offset + value_id] = 1
+        column = data.column(self.name)
+        # map value ids of the table to column ids
+        value_map = np.full(len(data.values) + 1, -1, dtype=np.int64)
+        for v, value_id in self.dict._str_to_id.items():
+            table_value_id = data.value_to_id(v)
+            if table_value_id >= 0:
+                value_map[table_value_id] = value_id
+        value_ids = value_map[column.values]
+        if self.neg:
+            rows, value_ids = complement_entries(column, value_ids, len(self.dict))
+        else:
+            rows = column.entry_rows()[value_ids >= 0]
+            value_ids = value_ids[value_ids >= 0]
+        if len(rows) > 0:
+            X[rows, offset + value_ids] = 1
 
     def get_all_names(self):
-        return ["%s=%s" % (self.name, v) for v in self.dict._id_to_str]
+        return ["%s%s%s" % (self.name, "!=" if self.neg else "=", v) for v in self.dict._id_to_str]
 
     def __len__(self):
         if not self.initialized:
@@ -61,76 +274,49 @@ class ClassFeature:
             return len(self.dict)
 
 
-class IndicatorFeature:
-    def __init__(self, name):
-        self.name = name
-        self.initialized = False
-
-    def init_from_data(self, data):
-        values = set()
-        for dep in data:
-            if self.name in dep:
-                v = dep[self.name]
-                assert type(v) == set
-                values.update(v)
-        if len(values) == 0:
-            raise RuntimeError("No value found for feature")
-        self.dict = Dict(values)
-        self.initialized = True
-
-    def build_features(self, X, data, offset):
-        for i, dep in enumerate(data):
-            if self.name in dep:
-                for value in dep[self.name]:
-                    value_id = self.dict.str_to_id(value)
-                    X[i, offset + value_id] = 1
-
-    def get_all_names(self):
-        return ["%s=%s" % (self.name, v) for v in self.dict._id_to_str]
-
-    def __len__(self):
-        if not self.initialized:
-            raise RuntimeError("Feature not initialized")
-        else:
-            # it always takes a single column
-            return len(self.dict)
+class IndicatorFeature(ClassFeature):
+    # the table stores set features in CSR format,
+    # so the only difference with ClassFeature is that a row can have several values
+    is_set = True
 
 
 class AllSingletonFeatures:
-    def __init__(self, predicate=None):
+    def __init__(self, predicate=None, include_neg=False):
         self.predicate = predicate
         self.initialized = False
+        self.include_neg = include_neg
 
-    def init_from_data(self, data):
+    # keys: sorted names of the features present in data, see FeatureSet.init_from_data
+    def init_from_data(self, data, keys=None):
+        if keys is None:
+            keys = sorted(data.feature_names())
         class_feature_names = set()
         indicator_feature_names = set()
-        for dep in data:
-            for k, v in dep.items():
-                if self.predicate is not None and not self.predicate(k):
-                    continue
-                if type(v) == str:
-                    class_feature_names.add(k)
-                elif type(v) == set:
-                    indicator_feature_names.add(k)
-                else:
-                    raise RuntimeError("Unusable data type for feature %s: %s" % (k, type(v)))
-
-        if len(class_feature_names.intersection(indicator_feature_names)) != 0:
-            raise RuntimeError("Error in feature types")
+        for k in keys:
+            if self.predicate is not None and not self.predicate(k):
+                continue
+            if data.column(k).is_set:
+                indicator_feature_names.add(k)
+            else:
+                class_feature_names.add(k)
 
         self.features = list()
         self.len_ = 0
-        for name in class_feature_names:
-            feature = ClassFeature(name)
-            feature.init_from_data(data)
-            self.len_ += len(feature)
-            self.features.append(feature)
-
-        for name in indicator_feature_names:
-            feature = IndicatorFeature(name)
-            feature.init_from_data(data)
-            self.len_ += len(feature)
-            self.features.append(feature)
+        negs = [False, True] if self.include_neg else [False]
+        # sorted so that columns do not depend on the hash seed
+        for name in sorted(class_feature_names):
+            for neg in negs:
+                feature = ClassFeature(name, neg=neg)
+                feature.init_from_data(data)
+                self.len_ += len(feature)
+                self.features.append(feature)
+
+        for name in sorted(indicator_feature_names):
+            for neg in negs:
+                feature = IndicatorFeature(name, neg=neg)
+                feature.init_from_data(data)
+                self.len_ += len(feature)
+                self.features.append(feature)
         self.initialized = True
 
     def build_features(self, X, data, offset):
@@ -150,115 +336,135 @@ class AllSingletonFeatures:
             return self.len_
 
 
+# Each product is a tuple of literals (name, negated, value),
+# if include_neg, negated literals name!=value are also used (see literal_matrix).
+# Products are stored as an array of literal ids, one row per product,
+# and their names are only built by get_all_names.
 class AllProductFeatures:
-    def __init__(self, degree=2, weight=1, min_occurences=1, predicate=None):
+    def __init__(self, degree=2, weight=1, min_occurences=1, predicate=None, include_neg=False):
         self.predicate = predicate
         self.initialized = False
         self.degree = degree
         self.min_occurences = min_occurences
         self.weight = weight
-
-    def init_from_data(self, data):
-        class_feature_names = set()
-        indicator_feature_names = set()
-        for dep in data:
-            for k, v in dep.items():
-                if self.predicate is not None and not self.predicate(k):
-                    continue
-                if type(v) == str:
-                    class_feature_names.add(k)
-                elif type(v) == set:
-                    indicator_feature_names.add(k)
-                else:
-                    raise RuntimeError("Unusable data type for feature %s: %s" % (k, type(v)))
-
-        if len(class_feature_names.intersection(indicator_feature_names)) != 0:
-            raise RuntimeError("Error in feature types")
-
-        merged_features = {(False, k) for k in class_feature_names}.union((True, k) for k in indicator_feature_names)
-
-        feature_count = collections.defaultdict(lambda: 0)
-        for dep in data:
-            for names in itertools.combinations(merged_features, self.degree):
-                all_keys = []
-                for is_set_feature, name in names:
-                    if name not in dep:
-                        break  # cannot build feature for this dep
-                    if is_set_feature:
-                        if len(all_keys) == 0:
-                            all_keys = [[(name, v)] for v in dep[name]]
-                        else:
-                            all_keys = [
-                                k + [(name, v)]
-                                for k in all_keys
-                                for v in dep[name]
-                            ]
-                    else:
-                        if len(all_keys) == 0:
-                            all_keys = [[(name, dep[name])]]
-                        else:
-                            all_keys = [k + [(name, dep[name])] for k in all_keys]
-                else:
-                    # exit without break
-                    for key in all_keys:
-                        key = tuple(key)
-                        feature_count[key] += 1
-
-        # filter on number of occurences
-        if self.min_occurences > 1:
-            filtered_features = list(k for k, v in feature_count.items() if v >= self.min_occurences)
-        else:
-            filtered_features = list(feature_count.keys())
-
-        self.templates = dict()
-        self.n_features = 0
-        for feature in filtered_features:
-            ks = tuple(k for k, _ in feature)
-            vs = tuple(v for _, v in feature)
-            if ks not in self.templates:
-                self.templates[ks] = {vs: self.n_features}
-            elif vs not in self.templates[ks]:  # is this test really necessary?!
-                self.templates[ks][vs] = self.n_features
-            else:
-                print(feature)
-                print(ks)
-                print(self.templates[ks])
-                raise RuntimeError("SHOULD NOT HAPPEN")
-            self.n_features += 1
-
+        self.include_neg = include_neg
+
+    # keys: sorted names of the features present in data, see FeatureSet.init_from_data
+    def init_from_data(self, data, keys=None):
+        if keys is None:
+            keys = sorted(data.feature_names())
+        feature_names = list()
+        for k in keys:
+            if self.predicate is not None and not self.predicate(k):
+                continue
+            feature_names.append(k)
+
+        self.literals, self.items = self._count_frequent(data, feature_names)
+        self.n_features = len(self.items)
         self.initialized = True
-        self.valid_features = filtered_features
 
+    # Frequent itemset mining on the binary literal matrix X, level by level (Apriori):
+    # itemsets of size k are extensions of frequent itemsets of size k-1
+    # with a literal of a feature that comes after all the features of the itemset.
+    # If P is the row indicator matrix of some itemsets,
+    # (P^T X)[i, j] is the number of rows that contain both itemset i and literal j,
+    # so each level is counted with sparse products, by blocks of itemsets.
+    # As counts are exact and only frequent itemsets are extended,
+    # all the subsets of a kept itemset also occur at least min_occurences times.
+    #
+    # If include_neg, an itemset that occurs as often as one of its subsets is not kept (nor extended):
+    # it occurs in exactly the same rows, so its column would be merged with the one of the subset
+    # (see FeatureSet.build_features), and so would the columns of its extensions.
+    # Itemsets with a negated literal of a rare value are often in this case (e.g. x=a,y!=b when y is never b with x=a),
+    # so this is what keeps the number of products tractable with negated literals.
+    # An itemset never contains two literals of the same feature, e.g. both x=a and x!=a.
+    #
+    # Returns the literals (name, negated, value) used by the products,
+    # and the products as an array of literal ids.
+    def _count_frequent(self, data, feature_names):
+        X, literal_names, literal_values, literal_negated = literal_matrix(
+            data, feature_names, self.min_occurences, include_neg=self.include_neg
+        )
+        literal_counts = np.diff(X.indptr)
+        items = np.arange(X.shape[1], dtype=np.int64)[:, None]
+        item_counts = literal_counts
+        for level in range(2, self.degree + 1):
+            new_items = [np.zeros((0, level), dtype=np.int64)]
+            new_counts = [np.zeros(0, dtype=np.int64)]
+            n_items = 0
+            for start in range(0, len(items), ITEMSET_BLOCK_SIZE):
+                block = items[start:start + ITEMSET_BLOCK_SIZE]
+                P = X[:, block[:, 0]]
+                for k in range(1, level - 1):
+                    P = P.multiply(X[:, block[:, k]])
+                counts = (P.T @ X).tocoo()
+                keep = (
+                    (counts.data >= self.min_occurences)
+                    & (literal_names[counts.col] > literal_names[block[counts.row, -1]])
+                )
+                if self.include_neg:
+                    # subsets without the new literal, or with only the new literal
+                    keep &= (
+                        (counts.data < item_counts[start + counts.row])
+                        & (counts.data < literal_counts[counts.col])
+                    )
+                new_items.append(np.concatenate(
+                    [block[counts.row[keep]], counts.col[keep][:, None]],
+                    axis=1
+                ))
+                new_counts.append(counts.data[keep].astype(np.int64))
+                n_items += keep.sum()
+                if n_items > MAX_PRODUCT_FEATURES:
+                    raise TooManyProductFeatures(
+                        "More than %i product features of degree %i, increase the minimum number of occurences or decrease the degree"
+                        % (MAX_PRODUCT_FEATURES, level)
+                    )
+            new_items = np.concatenate(new_items)
+            new_counts = np.concatenate(new_counts)
+            if self.include_neg and level > 2:
+                keep = smaller_than_subsets(new_items, new_counts, items, item_counts, X.shape[1])
+                new_items, new_counts = new_items[keep], new_counts[keep]
+            items, item_counts = new_items, new_counts
+
+        # same order as a join on each combination of features:
+        # grouped by features, then by values (positive literals first).
+        # Values are sorted as strings and not by id,
+        # so that the order does not depend on the order of the dependencies in data
+        literal_order = np.array(sorted(
+            range(len(literal_names)),
+            key=lambda i: (literal_names[i], literal_negated[i], data.values[literal_values[i]])
+        ), dtype=np.int64)
+        literal_ranks = np.zeros(len(literal_names), dtype=np.int64)
+        literal_ranks[literal_order] = np.arange(len(literal_names))
+        items = literal_ranks[items]
+        order = np.lexsort(tuple(items.T[::-1]) + tuple(literal_names[literal_order][items].T[::-1]))
+
+        # only the literals used by products are kept, in the same order
+        used = np.flatnonzero(np.bincount(items.reshape(-1), minlength=len(literal_names)) > 0)
+        literal_ids = np.full(len(literal_names), -1, dtype=np.int64)
+        literal_ids[used] = np.arange(len(used))
+        literals = [
+            (feature_names[literal_names[i]], bool(literal_negated[i]), data.values[literal_values[i]])
+            for i in literal_order[used].tolist()
+        ]
+        return literals, literal_ids[items[order]]
+
+    # Each product is the elementwise product of the columns of its literals,
+    # computed by blocks of products
     def build_features(self, X, data, int offset):
-        cdef int i, j
-
-        for i, dep in enumerate(data):
-            for ks, ks_vs in self.templates.items():
-                instance_values = list()
-                valid = True
-                for k in ks:
-                    if k not in dep:
-                        valid = False
-                        break
-                    elif type(dep[k]) == str:
-                        if len(instance_values) == 0:
-                            instance_values = [[dep[k]]]
-                        else:
-                            instance_values = [vs + [dep[k]] for vs in instance_values]
-                    else:
-                        if len(instance_values) == 0:
-                            instance_values = [[v] for v in dep[k]]
-                        else:
-                            instance_values = [vs + [v] for vs in instance_values for v in dep[k]]
-
-                if valid:
-                    for vs in instance_values:
-                        j = ks_vs.get(tuple(vs), -1)
-                        if j >= 0:
-                            X[i, offset + j] = self.weight
+        L = literal_columns(data, self.literals)
+        for start in range(0, len(self.items), ITEMSET_BLOCK_SIZE):
+            block = self.items[start:start + ITEMSET_BLOCK_SIZE]
+            P = L[:, block[:, 0]]
+            for k in range(1, self.degree):
+                P = P.multiply(L[:, block[:, k]])
+            P = P.tocoo()
+            if P.nnz > 0:
+                X[P.row, offset + start + P.col] = self.weight
 
     def get_all_names(self):
-        return [",".join("%s=%s" % (k, v) for k, v in feature) for feature in self.valid_features]
+        literal_names = ["%s%s%s" % (k, "!=" if n else "=", v) for k, n, v in self.literals]
+        return [",".join(literal_names[i] for i in item) for item in self.items.tolist()]
 
     def __len__(self):
         if not self.initialized:
@@ -268,24 +474,91 @@ class AllProductFeatures:
             return self.n_features
 
 
+# Group identical columns of a CSC matrix.
+# Columns are hashed with random projections of their content,
+# and columns with the same hash are compared exactly.
+# Returns a list of groups, each group is the sorted array of the indices of identical columns,
+# groups are sorted by their first column.
+def identical_columns(X):
+    X = scipy.sparse.csc_matrix(X)
+    X.sort_indices()
+    # with sorted indices, identical columns give exactly the same floating point sums
+    projections = np.random.RandomState(0).rand(2, X.shape[0]) @ X
+    signatures = np.column_stack([np.diff(X.indptr), projections.T])
+    _, inverse = np.unique(signatures, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    order = np.argsort(inverse, kind="stable")
+    starts = np.flatnonzero(np.diff(inverse[order], prepend=-1))
+    sizes = np.diff(np.append(starts, len(order)))
+    # columns with a unique signature are not compared
+    groups = [order[i:i + 1] for i in starts[sizes == 1]]
+    for i, size in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+        candidates = order[i:i + size]
+        while len(candidates) > 0:
+            first = candidates[0]
+            first_rows = X.indices[X.indptr[first]:X.indptr[first + 1]]
+            first_data = X.data[X.indptr[first]:X.indptr[first + 1]]
+            same = np.array([
+                np.array_equal(X.indices[X.indptr[j]:X.indptr[j + 1]], first_rows)
+                and np.array_equal(X.data[X.indptr[j]:X.indptr[j + 1]], first_data)
+                for j in candidates
+            ])
+            groups.append(candidates[same])
+            candidates = candidates[~same]
+    groups.sort(key=lambda group: group[0])
+    return groups
+
+
+# Merge identical rows of X that have the same target,
+# rows are grouped with identical_columns applied on the transpose of [X, y].
+# Returns the unique rows, their targets and their number of occurences,
+# unique rows are in the order of their first occurence.
+def unique_rows(X, y):
+    groups = identical_columns(scipy.sparse.hstack([X, y[:, None]], format="csr").T)
+    rows = np.array([group[0] for group in groups], dtype=np.int64)
+    counts = np.array([len(group) for group in groups], dtype=np.float64)
+    return scipy.sparse.csr_matrix(X)[rows].tocsc(), y[rows], counts
+
+
 class FeatureSet:
     def __init__(self):
         self.features = list()
+        # name of each feature, built once by init_from_data
+        self.names = None
+        # if columns are collapsed by build_features,
+        # for each column of X, the index of the feature that names it
+        # and the indices of the other identical features
+        self.columns = None
+        self.groups = None
 
     def add_feature(self, feature):
         self.features.append(feature)
 
+    # data can be a DependencyTable or a list of dependency dicts
+    # The key schema of data is collected once and shared by all feature families,
+    # so the predicate of each family is evaluated once per distinct key,
+    # independently of the number of dependencies
     def init_from_data(self, data):
+        data = as_table(data)
+        keys = sorted(data.feature_names())
         for feature in self.features:
-            feature.init_from_data(data)
-
-    def build_features(self, data, sparse=True):
+            feature.init_from_data(data, keys=keys)
+        self.names = list(itertools.chain(*[feature.get_all_names() for feature in self.features]))
+
+    # If sparse, returns a CSC matrix with int32 indices,
+    # data is float32 as all features are binary (or weighted products)
+    #
+    # If collapse, identical columns are merged into a single column of X,
+    # e.g. a product with a factor that is constant in data is identical to a singleton.
+    # Weights given to feature_weights must then be weights of the collapsed columns.
+    def build_features(self, data, sparse=True, dtype=np.float32, collapse=False):
+        data = as_table(data)
         n_columns = sum(len(f) for f in self.features)
         if sparse:
-            # TODO: check in celer what kind of sparse matrix it can use
-            X = scipy.sparse.lil_matrix((len(data), n_columns))
+            X = SparseMatrixBuilder((len(data), n_columns), dtype=dtype)
         else:
-            X = np.zeros((len(data), n_columns))
+            X = np.zeros((len(data), n_columns), dtype=dtype)
 
         offset = 0
         for feature in self.features:
@@ -293,19 +566,51 @@ class FeatureSet:
             offset += len(feature)
 
         if sparse:
-            X = scipy.sparse.csc_matrix(X)
+            X = X.build()
+
+        self.columns = None
+        self.groups = None
+        if collapse:
+            if not sparse:
+                raise RuntimeError("Only sparse features can be collapsed")
+            self.groups = identical_columns(X)
+            self.columns = np.array([group[0] for group in self.groups], dtype=np.int64)
+            X = X[:, self.columns]
         return X
 
+    def get_all_names(self):
+        return self.names
+
+    # Name of the feature of column offset of X
+    def column_name(self, offset):
+        if self.columns is not None:
+            offset = self.columns[offset]
+        return self.names[offset]
+
+    # Names of the features of each column of X
+    def column_names(self):
+        if self.columns is None:
+            return self.names
+        return [self.names[j] for j in self.columns]
+
+    # Names of the other features identical to the feature of column offset of X
+    def feature_aliases(self, offset):
+        if self.groups is None:
+            return []
+        return [self.names[j] for j in self.groups[offset][1:]]
+
+    # Only the names of columns with a non-zero weight are resolved,
+    # so the cost depends on the size of the support, not on the number of columns
     def feature_weights(self, weights, ignore_zeros=True):
-        ret = dict()
-        offset = 0
-        for feature in self.features:
-            names = feature.get_all_names()
-            for i, name in enumerate(names):
-                if not ignore_zeros or not np.isclose(weights[offset], 0):
-                    ret[name] = (weights[offset], offset)
-                offset += 1
-        return ret
+        weights = np.asarray(weights)
+        if ignore_zeros:
+            offsets = np.flatnonzero(np.logical_not(np.isclose(weights, 0)))
+        else:
+            offsets = np.arange(len(weights))
+        return {
+            self.column_name(offset): (weights[offset], offset)
+            for offset in offsets.tolist()
+        }
 
     def print_weights(self, weights, ignore_zeros=True):
         for n, (v, _) in self.feature_weights(weights, ignore_zeros=ignore_zeros).items():
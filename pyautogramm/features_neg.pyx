@@ -5,6 +5,10 @@ import scipy.sparse
 
 from pyautogramm.utils import Dict
 
+
+# Old implementation of negative features on lists of dependency dicts,
+# see include_neg in pyautogramm.features for the one used by the extractors
+
 # Should not be used,
 # I implemented this because unregularized intercept term
 # was not implemented in celer. However, as I now use skglm,
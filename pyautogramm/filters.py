@@ -0,0 +1,203 @@
+import numpy as np
+
+
+# Filters built from command line arguments.
+# They are classes instead of lambdas so that they can be sent to worker processes.
+
+
+# relations of the governor that are always excluded from the analysis
+EXCLUDED_GOV_RELS = ["orphan", "goeswith", "reparandum"]
+
+
+# features whose values may contain "|"
+PIPE_VALUE_SUFFIXES = (".in_upos",)
+
+
+# Dependency filter compiled from a string, e.g.:
+#   gov.upos=VERB,dep.upos=NOUN|dep.upos=PROPN,dep.Number!=Plur
+# - "," is a conjunction of clauses
+# - "|" is a disjunction of atoms inside a clause
+# - an atom is either key=value or key!=value,
+#   if the feature is a set, key=value means that the set contains value,
+#   e.g. grandchildren.upos=ADP is true if one of the children of the modifier is an ADP.
+#   key!=value is the negation of key=value, so it is also true if the key is missing.
+# A "|" that is not followed by an atom is part of the value only for features whose values
+# contain "|" (in_upos, see data.SIMILAR_POS_TAGS), so that dep.in_upos=NOUN|PROPN is a single atom,
+# otherwise the filter is invalid (e.g. gov.upos=NOUN|PROPN instead of gov.upos=NOUN|gov.upos=PROPN).
+#
+# The filter can be applied on dependency dicts (or table rows) with __call__,
+# or on a whole DependencyTable with mask.
+# Additionally, required features must be present in the dependency,
+# and predicate is an optional arbitrary callable (which cannot be vectorized).
+class DependencyFilter:
+    def __init__(self, clauses=(), required=(), predicate=None):
+        # list of clauses, each clause is a list of atoms (key, negated, value)
+        self.clauses = [list(clause) for clause in clauses]
+        self.required = list(required)
+        self.predicate = predicate
+
+    def __call__(self, dep):
+        return (
+            all(k in dep for k in self.required)
+            and all(
+                any(self._match(dep, k, v) != negated for k, negated, v in clause)
+                for clause in self.clauses
+            )
+            and (self.predicate is None or self.predicate(dep))
+        )
+
+    @staticmethod
+    def _match(dep, k, v):
+        if k not in dep:
+            return False
+        value = dep[k]
+        if type(value) == str:
+            return value == v
+        else:
+            return v in value
+
+    # Names of features used by the filter,
+    # or None if it depends on an arbitrary predicate.
+    def feature_names(self):
+        if self.predicate is not None:
+            return None
+        return set(self.required).union(k for clause in self.clauses for k, _, _ in clause)
+
+    def mask(self, table):
+        mask = np.ones(len(table), dtype=bool)
+        for k in self.required:
+            mask &= table.present(k)
+        for clause in self.clauses:
+            clause_mask = np.zeros(len(table), dtype=bool)
+            for k, negated, v in clause:
+                atom_mask = np.zeros(len(table), dtype=bool)
+                if k in table:
+                    column = table.column(k)
+                    value_id = table.value_to_id(v)
+                    if value_id >= 0:
+                        atom_mask[column.entry_rows()[column.values == value_id]] = True
+                clause_mask |= np.logical_not(atom_mask) if negated else atom_mask
+            mask &= clause_mask
+        if self.predicate is not None:
+            rows = np.flatnonzero(mask)
+            mask[rows] = np.fromiter((self.predicate(table.row(i)) for i in rows), dtype=bool, count=len(rows))
+        return mask
+
+    def require(self, names):
+        return DependencyFilter(self.clauses, self.required + list(names), self.predicate)
+
+    def __and__(self, other):
+        if self.predicate is not None and other.predicate is not None:
+            predicate = _AndPredicate(self.predicate, other.predicate)
+        else:
+            predicate = self.predicate if self.predicate is not None else other.predicate
+        return DependencyFilter(self.clauses + other.clauses, self.required + other.required, predicate)
+
+    def __str__(self):
+        ret = [
+            "|".join("%s%s%s" % (k, "!=" if negated else "=", v) for k, negated, v in clause)
+            for clause in self.clauses
+        ]
+        ret.extend("%s=*" % k for k in self.required)
+        if self.predicate is not None:
+            ret.append(repr(self.predicate))
+        return ",".join(ret)
+
+
+class _AndPredicate:
+    def __init__(self, predicate1, predicate2):
+        self.predicate1 = predicate1
+        self.predicate2 = predicate2
+
+    def __call__(self, dep):
+        return self.predicate1(dep) and self.predicate2(dep)
+
+
+def compile_dependency_filter(filter_str):
+    clauses = list()
+    for clause_str in filter_str.split(","):
+        if len(clause_str) == 0:
+            continue
+        clause = list()
+        for atom_str in clause_str.split("|"):
+            if atom_str.find("=") < 0:
+                if len(clause) == 0 or not clause[-1][0].endswith(PIPE_VALUE_SUFFIXES):
+                    raise RuntimeError("Invalid dependency filter: %s" % clause_str)
+                # the "|" was part of a value
+                k, negated, v = clause[-1]
+                clause[-1] = (k, negated, v + "|" + atom_str)
+                continue
+            if atom_str.find("!=") >= 0:
+                k, v = atom_str.split("!=", 1)
+                negated = True
+            else:
+                k, v = atom_str.split("=", 1)
+                negated = False
+            if len(k) == 0:
+                raise RuntimeError("Invalid dependency filter: %s" % clause_str)
+            clause.append((k, negated, v))
+        clauses.append(clause)
+    return DependencyFilter(clauses)
+
+
+def default_dependency_filter():
+    return compile_dependency_filter(",".join("gov.rel_synt!=%s" % rel for rel in EXCLUDED_GOV_RELS))
+
+
+def as_dependency_filter(predicate):
+    if isinstance(predicate, DependencyFilter):
+        return predicate
+    return DependencyFilter(predicate=predicate)
+
+
+# feature filter:
+# feature names that include one of the feature_filter strings will be removed,
+# used for features that can spoilt the prediction.
+# Features used to filter dependencies (filtered_names) are also removed.
+# The result is cached, so the filter is evaluated only once per feature name and degree.
+class FeatureFilter:
+    def __init__(self, filtered_names, feature_filter):
+        self.filtered_names = set(filtered_names)
+        self.feature_filter = list(feature_filter)
+        self._cache = dict()
+
+    def __call__(self, degree, name):
+        ret = self._cache.get((degree, name))
+        if ret is None:
+            lower_name = name.lower()
+            ret = (
+                # if we filter by POS, we need to remove them
+                name not in self.filtered_names
+                and all(lower_name.find(f) < 0 for f in self.feature_filter)
+                # use endswith because we don't want to match patterns of the form lemma_UPOS or lemmas_UPOS
+                and (not lower_name.endswith("lemma"))
+                and (not lower_name.endswith("lemmas"))
+            )
+            self._cache[(degree, name)] = ret
+        return ret
+
+    # used to identify cache entries, see pyautogramm.cache.matrix_entry_path
+    def __str__(self):
+        return "%s;%s" % (",".join(sorted(self.filtered_names)), ",".join(self.feature_filter))
+
+
+# Features that must be built by the extractor:
+# features used by the dependency filter or to build targets (required),
+# and features accepted by the feature filter for at least one degree.
+# The feature filter is evaluated only once per feature name.
+class FeatureProjection:
+    def __init__(self, feature_predicate, max_degree, required=()):
+        self.feature_predicate = feature_predicate
+        self.max_degree = max_degree
+        self.required = set(required)
+        self._cache = dict()
+
+    def __call__(self, name):
+        ret = self._cache.get(name)
+        if ret is None:
+            ret = name in self.required or any(
+                self.feature_predicate(degree, name)
+                for degree in range(1, self.max_degree + 1)
+            )
+            self._cache[name] = ret
+        return ret
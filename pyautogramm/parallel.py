@@ -0,0 +1,62 @@
+import concurrent.futures
+import os
+
+import pyautogramm.cache
+import pyautogramm.profile
+
+
+# Raised by per-treebank functions when a treebank cannot be analysed,
+# the message is written in the error stream by the main process.
+class SkipTreebank(Exception):
+    pass
+
+
+def _run(function, treebank_path, i, n_treebanks, checkpoint, resume, kwargs):
+    # checkpoints are identified in the worker, as it requires reading all the files of the treebank
+    checkpoint_path = None if checkpoint is None else checkpoint(treebank_path)
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        data, error, profile = pyautogramm.cache.load_checkpoint(checkpoint_path)
+        if profile is not None:
+            profile = pyautogramm.profile.Profile.from_json(profile)
+        return (None if data is None else (data, profile)), error
+
+    try:
+        result, error = function(treebank_path, i, n_treebanks, **kwargs), None
+    except SkipTreebank as e:
+        result, error = None, str(e)
+    # saved by the worker, as soon as the treebank is finished
+    if checkpoint_path is not None:
+        pyautogramm.cache.save_checkpoint(
+            checkpoint_path,
+            None if result is None else result[0],
+            error,
+            None if result is None or result[1] is None else result[1].to_json()
+        )
+    return result, error
+
+
+# Apply function(treebank_path, i, n_treebanks, **kwargs) on each treebank,
+# function must return a pair (data, profile), see pyautogramm.profile.
+# Treebanks are independent, so if jobs > 1 they are processed in a process pool.
+# Yields (treebank_path, result, error) in the order of treebank_paths,
+# where result is None if the treebank was skipped and error is the reason.
+#
+# If checkpoint is given, checkpoint(treebank_path) is the checkpoint path of the treebank (or None),
+# see pyautogramm.cache.checkpoint_path, and data (or error) is saved in the checkpoint.
+# It must be picklable if jobs > 1.
+# If resume, treebanks whose checkpoint exists are not processed again,
+# their data and profile are loaded from the checkpoint
+# (without cProfile statistics, see pyautogramm.profile.Profile.from_json).
+def map_treebanks(function, treebank_paths, jobs=1, checkpoint=None, resume=False, **kwargs):
+    n_treebanks = len(treebank_paths)
+    if jobs <= 1:
+        for i, treebank_path in enumerate(treebank_paths):
+            yield (treebank_path,) + _run(function, treebank_path, i, n_treebanks, checkpoint, resume, kwargs)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(_run, function, treebank_path, i, n_treebanks, checkpoint, resume, kwargs)
+                for i, treebank_path in enumerate(treebank_paths)
+            ]
+            for treebank_path, future in zip(treebank_paths, futures):
+                yield (treebank_path,) + future.result()
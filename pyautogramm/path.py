@@ -0,0 +1,183 @@
+import time
+
+import numba
+import numpy as np
+import scipy.special
+import skglm
+
+
+# Regularization paths of the sparse logistic regression.
+# Paths are generators of (alpha, coefficients, intercept) in decreasing order of alpha,
+# each fit is warm-started from the solution of a larger alpha,
+# so the solver starts from its active set instead of zero coefficients.
+
+
+# Logistic loss where each sample i is counted sample_weights[i] times,
+# i.e. sum_i sample_weights[i] log(1 + exp(-y_i (Xw)_i)) / sum_i sample_weights[i],
+# so that merging identical samples (see features.unique_rows) does not change the objective.
+# It is compiled by skglm like its parent class,
+# and the normalized weights are computed once per fit by initialize (like Xty in skglm.datafits.Quadratic).
+class WeightedLogistic(skglm.datafits.Logistic):
+    def __init__(self, sample_weights):
+        self.sample_weights = sample_weights
+
+    def get_spec(self):
+        return (("sample_weights", numba.float64[:]), ("normalized_weights", numba.float64[:]))
+
+    def params_to_dict(self):
+        return dict(sample_weights=self.sample_weights)
+
+    def initialize(self, X, y):
+        self.normalized_weights = self.sample_weights / self.sample_weights.sum()
+
+    def initialize_sparse(self, X_data, X_indptr, X_indices, y):
+        self.normalized_weights = self.sample_weights / self.sample_weights.sum()
+
+    def raw_grad(self, y, Xw):
+        return -y / (1 + np.exp(y * Xw)) * self.normalized_weights
+
+    def raw_hessian(self, y, Xw):
+        exp_minus_yXw = np.exp(-y * Xw)
+        return exp_minus_yXw / (1 + exp_minus_yXw) ** 2 * self.normalized_weights
+
+    def value(self, y, w, Xw):
+        return (np.log(1. + np.exp(- y * Xw)) * self.normalized_weights).sum()
+
+
+# Sparse logistic regression with an L1 penalty (i.e. skglm.SparseLogisticRegression),
+# weighted if sample_weights is not None
+def new_model(alpha, sample_weights=None):
+    return skglm.GeneralizedLinearEstimator(
+        datafit=skglm.datafits.Logistic() if sample_weights is None else WeightedLogistic(sample_weights),
+        penalty=skglm.penalties.L1(alpha),
+        solver=skglm.solvers.ProxNewton(
+            max_iter=20,
+            max_pn_iter=1000,
+            fit_intercept=True,
+            warm_start=True
+        )
+    )
+
+
+# Smallest alpha for which all coefficients are zero.
+# With only the intercept, the model predicts the (weighted) mean p of y,
+# so the gradient of the loss wrt coefficients is -X^T (w * (y - p)) / sum(w).
+def max_alpha(X, y, sample_weights=None):
+    if sample_weights is None:
+        sample_weights = np.ones(X.shape[0])
+    p = np.average(y, weights=sample_weights)
+    return float(np.abs(X.T @ (sample_weights * (y - p))).max() / sample_weights.sum())
+
+
+# indices of non-zero coefficients, see FeatureSet.feature_weights
+def support(coef):
+    return np.flatnonzero(np.logical_not(np.isclose(coef, 0)))
+
+
+# relative tolerance of the KKT check of screened features
+KKT_TOLERANCE = 1e-3
+
+
+# absolute value of the gradient of the (weighted) logistic loss wrt each coefficient
+def _gradient(X, y, sample_weights, coef, intercept):
+    p = scipy.special.expit(X @ coef + intercept)
+    return np.abs(X.T @ (sample_weights * (y - p))) / sample_weights.sum()
+
+
+# Fit alpha, warm-started from start, a previous solution (alpha, coef, intercept) for a larger alpha.
+#
+# If screening, the sequential strong rule discards the features whose gradient at start
+# is smaller than 2 alpha - alpha_start (they are very likely to be zero),
+# and the model is only fitted on the remaining columns of X.
+# Discarded features must then satisfy the KKT condition (gradient <= alpha),
+# violating features are added back and the model is fitted again.
+# So the cost of each fit depends on the size of the active set rather than on the number of features.
+#
+# If log is a list, a summary of the fit is appended to it:
+# number of fitted columns, number of solver runs (1 + KKT refits),
+# number of outer solver iterations summed over runs, and wall time.
+def _fit(model, X, y, alpha, start=None, screening=True, sample_weights=None, log=None):
+    wall_start = time.perf_counter()
+    n_fits = 0
+    n_iter = 0
+    if sample_weights is None:
+        sample_weights = np.ones(X.shape[0])
+    if start is None:
+        # solution for max_alpha: only the intercept
+        mean = np.clip(np.average(y, weights=sample_weights), 1e-12, 1 - 1e-12)
+        start = (max_alpha(X, y, sample_weights), np.zeros(X.shape[1]), np.log(mean / (1 - mean)))
+    start_alpha, coef, intercept = start
+
+    if screening:
+        keep = _gradient(X, y, sample_weights, coef, intercept) >= 2 * alpha - start_alpha
+        keep[support(coef)] = True
+    else:
+        keep = np.ones(X.shape[1], dtype=bool)
+
+    while True:
+        columns = np.flatnonzero(keep)
+        if len(columns) > 0:
+            model.coef_ = coef[None, columns].copy()
+            model.intercept_ = intercept
+            model.n_features_in_ = len(columns)
+            model.penalty.alpha = alpha
+            model.fit(X[:, columns], y)
+            n_fits += 1
+            n_iter += model.n_iter_
+            coef = np.zeros(X.shape[1])
+            coef[columns] = model.coef_[0]
+            intercept = model.intercept_
+
+        violations = np.logical_not(keep) & (_gradient(X, y, sample_weights, coef, intercept) > alpha * (1 + KKT_TOLERANCE))
+        if not violations.any():
+            if log is not None:
+                log.append({
+                    "alpha": float(alpha),
+                    "n_columns": len(columns),
+                    "n_fits": n_fits,
+                    "n_iter": int(n_iter),
+                    "wall_time": time.perf_counter() - wall_start
+                })
+            return alpha, coef, intercept
+        keep |= violations
+
+
+# Fit all the alphas of a grid, which is expected to be decreasing
+def grid_path(X, y, alphas, screening=True, sample_weights=None, log=None):
+    model = new_model(alphas[0], sample_weights)
+    solution = None
+    for alpha in alphas:
+        solution = _fit(model, X, y, alpha, start=solution, screening=screening, sample_weights=sample_weights, log=log)
+        yield solution
+
+
+# Path that only fits where new features enter the support.
+# It starts at max_alpha and decreases alpha geometrically by ratio until alpha_min,
+# and each interval where features that were never selected at a larger alpha
+# enter the support is bisected (in log scale)
+# until the ratio of its ends is smaller than 1 + tolerance,
+# so the alpha at which a feature is first selected is known up to this tolerance.
+# Intervals without new features at their lower end are assumed not to contain any.
+# Solutions are yielded in decreasing order of alpha, so the caller can stop the path at any time.
+def adaptive_path(X, y, alpha_min, ratio=2., tolerance=0.05, screening=True, sample_weights=None, log=None):
+    model = new_model(alpha_min, sample_weights)
+    # features selected by the solutions yielded so far
+    selected = np.zeros(X.shape[1], dtype=bool)
+
+    # hi has already been yielded, yield solutions in (lo, hi) and then lo
+    def bisect(hi, lo):
+        if hi[0] / lo[0] > 1 + tolerance and not selected[support(lo[1])].all():
+            mid = _fit(model, X, y, np.sqrt(hi[0] * lo[0]), start=hi, screening=screening, sample_weights=sample_weights, log=log)
+            yield from bisect(hi, mid)
+            yield from bisect(mid, lo)
+        else:
+            selected[support(lo[1])] = True
+            yield lo
+
+    hi = _fit(model, X, y, max(max_alpha(X, y, sample_weights), alpha_min), screening=screening, sample_weights=sample_weights, log=log)
+    selected[support(hi[1])] = True
+    yield hi
+    while hi[0] > alpha_min:
+        lo = _fit(model, X, y, max(hi[0] / ratio, alpha_min), start=hi, screening=screening, sample_weights=sample_weights, log=log)
+        yield from bisect(hi, lo)
+        hi = lo
@@ -0,0 +1,117 @@
+import contextlib
+import cProfile
+import json
+import marshal
+import os
+import resource
+import sys
+import time
+
+
+# peak resident set size of this process in MB,
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+
+# CPU time of this process and of its terminated children (e.g. parse workers)
+def cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+# Resources used by the phases of the processing of a treebank.
+# A phase can be entered several times (e.g. fit and score are interleaved along the path),
+# its wall time and CPU time are summed over calls and its peak RSS is the high-water mark
+# of the process at the end of the phase (which includes previous treebanks if the process is reused).
+# Other information (matrix shape, solver iterations...) is stored with record.
+#
+# If cprofile, each phase is also profiled with cProfile,
+# and only the statistics of the hottest phase (largest wall time) are kept by finish,
+# they can be written with dump_stats and read with pstats.
+# Profiles are pickled to be sent back from worker processes, so they only contain plain data.
+class Profile:
+    def __init__(self, cprofile=False):
+        self.phases = dict()
+        self.info = dict()
+        self.cprofile = cprofile
+        self.stats = None
+        self._profilers = dict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stats = self.phases.setdefault(name, {"calls": 0, "wall_time": 0., "cpu_time": 0., "peak_rss": 0.})
+        if self.cprofile:
+            profiler = self._profilers.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield
+        finally:
+            stats["calls"] += 1
+            stats["wall_time"] += time.perf_counter() - wall_start
+            stats["cpu_time"] += cpu_time() - cpu_start
+            stats["peak_rss"] = max(stats["peak_rss"], peak_rss())
+            if self.cprofile:
+                profiler.disable()
+
+    # iterate over iterable, each step being timed as a call to the phase
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, key, value):
+        self.info[key] = value
+
+    def hottest_phase(self):
+        if len(self.phases) == 0:
+            return None
+        return max(self.phases, key=lambda name: self.phases[name]["wall_time"])
+
+    def finish(self):
+        hottest = self.hottest_phase()
+        if hottest in self._profilers:
+            profiler = self._profilers[hottest]
+            profiler.create_stats()
+            self.stats = profiler.stats
+        self._profilers = dict()
+
+    # same format as cProfile.Profile.dump_stats
+    def dump_stats(self, path):
+        with open(path, "wb") as ostream:
+            marshal.dump(self.stats, ostream)
+
+    def to_json(self):
+        return {
+            "phases": self.phases,
+            "hottest_phase": self.hottest_phase(),
+            **self.info
+        }
+
+    # profile saved by to_json, e.g. in a checkpoint,
+    # cProfile statistics are not saved so they are not restored
+    @staticmethod
+    def from_json(data):
+        profile = Profile()
+        profile.phases = data["phases"]
+        profile.info = {k: v for k, v in data.items() if k not in ("phases", "hottest_phase")}
+        return profile
+
+
+# Write the profiles of all treebanks (dict treebank name -> Profile) in json,
+# and the cProfile statistics of each treebank next to it,
+# e.g. output.profile.json and output.profile.<treebank>.prof
+def save_profiles(path, profiles):
+    with open(path, "w") as ostream:
+        json.dump({name: profile.to_json() for name, profile in profiles.items()}, ostream, indent=1)
+    for name, profile in profiles.items():
+        if profile.stats is not None:
+            profile.dump_stats("%s.%s.prof" % (os.path.splitext(path)[0], name))
@@ -0,0 +1,58 @@
+import numpy as np
+import scipy.sparse
+import scipy.special
+import scipy.stats
+
+
+# Statistics of the rules of a batch of columns of X, computed as arrays.
+# Rows of X are weighted by sample_weights (number of occurences of each unique row),
+# counts are computed in one pass over the CSC arrays of the selected columns.
+#
+# The G-statistic compares the rate of positive targets among matched rows
+# to the rate mu in all rows:
+#   G = 2 n_matched (a log(a / mu) + (1 - a) log((1 - a) / (1 - mu)))
+# where a is the rate among matched rows.
+def score_rules(X, y, sample_weights, columns):
+    X = scipy.sparse.csc_matrix(X[:, columns])
+    matched = scipy.sparse.csc_matrix((X.data > 0, X.indices, X.indptr), shape=X.shape, dtype=np.float64)
+
+    n_total = sample_weights.sum()
+    n_yes = (sample_weights * y).sum()
+    n_matched = matched.T @ sample_weights
+    n_positive = matched.T @ (sample_weights * y)
+
+    mu = n_yes / n_total
+    a = n_positive / n_matched
+    gstat = 2 * n_matched * (
+        scipy.special.xlogy(a, a) - a * np.log(mu)
+        + scipy.special.xlogy(1 - a, 1 - a) - (1 - a) * np.log(1 - mu)
+    )
+    expected = n_matched * n_yes / n_total
+
+    return {
+        "n_pattern_occurence": X.T @ sample_weights,
+        "n_matched": n_matched,
+        "n_pattern_positive_occurence": n_positive,
+        "n_pattern_negative_occurence": n_matched - n_positive,
+        "positive_rate": a,
+        "g-statistic": gstat,
+        "p-value": scipy.stats.chi2.sf(gstat, 1),
+        "cramers_phi": np.sqrt(gstat / n_matched),
+        "delta": n_positive - expected,
+    }
+
+
+# Coverage and precision (in %) of each rule,
+# for the positive targets if yes is true, for the negative ones otherwise
+def coverage_precision(scores, yes, n_yes, n_total):
+    coverage = np.where(
+        yes,
+        scores["n_pattern_positive_occurence"] / n_yes,
+        scores["n_pattern_negative_occurence"] / (n_total - n_yes)
+    ) * 100
+    precision = np.where(
+        yes,
+        scores["n_pattern_positive_occurence"],
+        scores["n_pattern_negative_occurence"]
+    ) / scores["n_matched"] * 100
+    return coverage, precision
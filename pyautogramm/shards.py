@@ -0,0 +1,48 @@
+import json
+import os
+
+
+# Sharded output for the html dashboard (see html/display_results.js):
+# a small index with a summary of each treebank,
+# and the rules of each treebank in a separate file that is loaded when the treebank is displayed.
+# e.g. for output.index.json, shards are output.shards/<treebank>.json,
+# and their paths in the index are relative to the index.
+#
+# Shards are compact: the fields of the rules are given once,
+# and each rule is the list of its values in the same order.
+
+
+def shard_directory(index_path):
+    return os.path.splitext(os.path.splitext(index_path)[0])[0] + ".shards"
+
+
+def save_shards(index_path, extracted_data):
+    directory = shard_directory(index_path)
+    os.makedirs(directory, exist_ok=True)
+
+    index = dict()
+    for treebank_name, treebank_data in extracted_data.items():
+        rules = treebank_data["rules"]
+        fields = list(rules[0].keys()) if len(rules) > 0 else list()
+        shard_path = os.path.join(directory, "%s.json" % treebank_name)
+        with open(shard_path, "w", encoding="utf-8") as ostream:
+            json.dump(
+                {
+                    "fields": fields,
+                    "rules": [[rule[field] for field in fields] for rule in rules],
+                    "intercepts": treebank_data["intercepts"]
+                },
+                ostream,
+                separators=(",", ":")
+            )
+
+        index[treebank_name] = {
+            "filtered_deps_len": treebank_data["filtered_deps_len"],
+            "n_yes": treebank_data["n_yes"],
+            "n_rules": len(rules),
+            "n_yes_rules": sum(1 for rule in rules if rule["decision"] == "yes"),
+            "shard": os.path.relpath(shard_path, os.path.dirname(os.path.abspath(index_path))).replace(os.sep, "/")
+        }
+
+    with open(index_path, "w", encoding="utf-8") as ostream:
+        json.dump(index, ostream)
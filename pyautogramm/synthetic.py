@@ -0,0 +1,85 @@
+import random
+
+
+# Synthetic treebanks in the conllu format, used by autogramm_benchmark.py
+# to measure the performance of the pipeline without a copy of SUD.
+# Annotations are random, so only the sizes matter (number of dependencies,
+# number of distinct feature values, depth and branching of trees), not the extracted rules.
+
+UPOS_TAGS = [
+    "NOUN", "PROPN", "VERB", "AUX", "ADJ", "ADV", "ADP", "DET",
+    "PRON", "NUM", "SCONJ", "CCONJ", "PART", "PUNCT"
+]
+
+RELATIONS = [
+    "subj", "comp:obj", "comp:obl", "comp:aux", "comp:pred", "mod", "det",
+    "udep", "cc", "conj", "punct", "flat", "compound", "mod@relcl", "comp:obj@lvc"
+]
+
+FEATURE_NAMES = [
+    "Number", "Gender", "Case", "Person", "Tense", "Mood",
+    "VerbForm", "Definite", "PronType", "Degree", "Voice", "Aspect"
+]
+
+TREE_SHAPES = ("random", "flat", "chain")
+
+
+# Heads of the words 1..n of a sentence (0 is the root).
+# - random: each word is attached to a word already in the tree (random recursive tree),
+#   so trees have a logarithmic depth and a few words with many children
+# - flat: all words are attached to the root word
+# - chain: each word is attached to the previous one
+def random_heads(r, n, tree_shape="random"):
+    if tree_shape not in TREE_SHAPES:
+        raise RuntimeError("Unknown tree shape: %s" % tree_shape)
+    order = list(range(1, n + 1))
+    r.shuffle(order)
+    heads = [0] * (n + 1)
+    for k, i in enumerate(order[1:], start=1):
+        if tree_shape == "random":
+            heads[i] = order[r.randrange(k)]
+        elif tree_shape == "flat":
+            heads[i] = order[0]
+        else:
+            heads[i] = order[k - 1]
+    return heads[1:]
+
+
+# Write n_sentences random sentences in path.
+# Sentence lengths are uniform in [sentence_length / 2, 3 sentence_length / 2],
+# each word has each of the first n_features morphological features with probability 1/2,
+# with n_values possible values, and lemmas are drawn from n_lemmas possible values.
+# Returns the number of words.
+def generate(path, n_sentences, sentence_length=15, n_features=6, n_values=3, n_lemmas=200, tree_shape="random", seed=0):
+    if n_features > len(FEATURE_NAMES):
+        raise RuntimeError("At most %i features can be generated" % len(FEATURE_NAMES))
+    r = random.Random(seed)
+    n_words = 0
+    with open(path, "w", encoding="utf-8") as ostream:
+        for s in range(n_sentences):
+            n = r.randint(max(1, sentence_length // 2), max(1, (3 * sentence_length) // 2))
+            heads = random_heads(r, n, tree_shape)
+            ostream.write("# sent_id = synthetic-%i\n" % s)
+            for i, head in enumerate(heads, start=1):
+                lemma = "l%i" % r.randrange(n_lemmas)
+                feats = "|".join(
+                    "%s=V%i" % (name, r.randrange(n_values))
+                    for name in FEATURE_NAMES[:n_features]
+                    if r.random() < 0.5
+                )
+                ostream.write("\t".join([
+                    str(i),
+                    lemma,
+                    lemma,
+                    r.choice(UPOS_TAGS),
+                    "_",
+                    feats if len(feats) > 0 else "_",
+                    str(head),
+                    "root" if head == 0 else r.choice(RELATIONS),
+                    "_",
+                    "_"
+                ]))
+                ostream.write("\n")
+            ostream.write("\n")
+            n_words += n
+    return n_words
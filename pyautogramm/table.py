@@ -0,0 +1,388 @@
+import array
+import json
+import os
+
+import numpy as np
+
+
+# Columnar storage of dependencies.
+#
+# Instead of one python dict per dependency,
+# keys (e.g. "gov.upos") and values (e.g. "VERB") are interned
+# and each key is stored as an integer-coded column.
+# Columns are sparse: only rows (i.e. dependencies) where the key is present are stored.
+#
+# - rows: sorted ids of the rows where the key is present
+# - values: value ids
+# - offsets: for set features only, values of rows[i] are values[offsets[i]:offsets[i+1]] (CSR format).
+#   Note that a set feature can be present with an empty set.
+#   For class features, there is exactly one value per row, so offsets is not stored.
+class Column:
+    def __init__(self, is_set, rows, values, offsets=None):
+        self.is_set = is_set
+        self.rows = rows
+        self.values = values
+        self._offsets = offsets
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            return np.arange(len(self.rows) + 1, dtype=np.int64)
+        return self._offsets
+
+    def __len__(self):
+        return len(self.rows)
+
+    # row of each value
+    def entry_rows(self):
+        if self.is_set:
+            return np.repeat(self.rows, np.diff(self._offsets))
+        else:
+            return self.rows
+
+    # for class features only, value id of each row, -1 if missing
+    def dense(self, n_rows):
+        if self.is_set:
+            raise RuntimeError("Cannot build a dense column for a set feature")
+        ret = np.full(n_rows, -1, dtype=np.int32)
+        ret[self.rows] = self.values
+        return ret
+
+    # index of row in self.rows, or -1 if the key is not present in this row
+    def find(self, row):
+        i = np.searchsorted(self.rows, row)
+        if i < len(self.rows) and self.rows[i] == row:
+            return int(i)
+        return -1
+
+    # new_ids: new id of each row, or -1 if the row is removed
+    def select(self, new_ids):
+        new_rows = new_ids[self.rows]
+        kept = new_rows >= 0
+        if self.is_set:
+            counts = np.diff(self._offsets)[kept]
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            values = self.values[np.repeat(kept, np.diff(self._offsets))]
+            return Column(True, new_rows[kept].astype(np.int32), values, offsets)
+        else:
+            return Column(False, new_rows[kept].astype(np.int32), self.values[kept])
+
+
+class DependencyTable:
+    def __init__(self, n_rows, keys, values, columns):
+        self.n_rows = n_rows
+        self.keys = keys
+        self.values = values
+        self.columns = columns
+        self._key_to_id = {k: i for i, k in enumerate(keys)}
+        self._value_to_id = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, name):
+        return name in self._key_to_id
+
+    def column(self, name):
+        return self.columns[self._key_to_id[name]]
+
+    def value_to_id(self, v):
+        if self._value_to_id is None:
+            self._value_to_id = {v: i for i, v in enumerate(self.values)}
+        return self._value_to_id.get(v, -1)
+
+    # boolean mask of rows where the feature is present
+    def present(self, name):
+        mask = np.zeros(self.n_rows, dtype=bool)
+        if name in self:
+            mask[self.column(name).rows] = True
+        return mask
+
+    # names of features that are present in at least one row
+    def feature_names(self):
+        return [k for k, column in zip(self.keys, self.columns) if len(column) > 0]
+
+    def row(self, i):
+        return TableRow(self, i)
+
+    def __iter__(self):
+        for i in range(self.n_rows):
+            yield self.row(i)
+
+    def to_dicts(self):
+        return [row.to_dict() for row in self]
+
+    # rows: boolean mask or array of row ids
+    def select(self, rows):
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        new_ids = np.full(self.n_rows, -1, dtype=np.int64)
+        new_ids[rows] = np.arange(len(rows))
+        return DependencyTable(
+            len(rows),
+            self.keys,
+            self.values,
+            [column.select(new_ids) for column in self.columns]
+        )
+
+    # Keep only features whose name satisfies the predicate
+    def project(self, features):
+        keys = list()
+        columns = list()
+        for k, column in zip(self.keys, self.columns):
+            if features(k):
+                keys.append(k)
+                columns.append(column)
+        return DependencyTable(self.n_rows, keys, self.values, columns)
+
+    # Keep rows that satisfy the predicate.
+    # The predicate receives a TableRow, which behaves like a read-only dependency dict,
+    # so only the keys that are used by the predicate are decoded.
+    def filter(self, predicate):
+        mask = np.fromiter((predicate(row) for row in self), dtype=bool, count=self.n_rows)
+        return self.select(mask)
+
+    @staticmethod
+    def concatenate(tables):
+        keys = list()
+        key_to_id = dict()
+        is_set = list()
+        values = list()
+        value_to_id = dict()
+        for table in tables:
+            for k, column in zip(table.keys, table.columns):
+                if k not in key_to_id:
+                    key_to_id[k] = len(keys)
+                    keys.append(k)
+                    is_set.append(column.is_set)
+                elif is_set[key_to_id[k]] != column.is_set:
+                    raise RuntimeError("Error in feature types")
+            for v in table.values:
+                if v not in value_to_id:
+                    value_to_id[v] = len(values)
+                    values.append(v)
+
+        parts = [list() for _ in keys]
+        row_offset = 0
+        for table in tables:
+            value_map = np.fromiter((value_to_id[v] for v in table.values), dtype=np.int32, count=len(table.values))
+            for k, column in zip(table.keys, table.columns):
+                parts[key_to_id[k]].append((row_offset, column, value_map))
+            row_offset += table.n_rows
+
+        columns = list()
+        for key_id in range(len(keys)):
+            rows = [column.rows.astype(np.int32) + o for o, column, _ in parts[key_id]]
+            col_values = [value_map[column.values] for _, column, value_map in parts[key_id]]
+            rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int32)
+            col_values = np.concatenate(col_values) if len(col_values) > 0 else np.zeros(0, dtype=np.int32)
+            if is_set[key_id]:
+                counts = [np.diff(column.offsets) for _, column, _ in parts[key_id]]
+                counts = np.concatenate(counts) if len(counts) > 0 else np.zeros(0, dtype=np.int64)
+                offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[1:])
+                columns.append(Column(True, rows, col_values, offsets))
+            else:
+                columns.append(Column(False, rows, col_values))
+
+        return DependencyTable(row_offset, keys, values, columns)
+
+    # Build a table from a flat list of (key, value) entries, see DependencyTableBuilder
+    @staticmethod
+    def from_entries(dep_offsets, entry_keys, entry_values, keys, set_keys, values):
+        n_rows = len(dep_offsets) - 1
+        entry_keys = np.asarray(entry_keys)
+        entry_values = np.asarray(entry_values)
+        entry_rows = np.repeat(np.arange(n_rows, dtype=np.int32), np.diff(dep_offsets))
+
+        # group entries by key,
+        # the sort is stable so rows are still sorted inside each group
+        order = np.argsort(entry_keys, kind="stable")
+        boundaries = np.searchsorted(entry_keys[order], np.arange(len(keys) + 1))
+
+        set_keys = set(set_keys)
+        columns = list()
+        for key_id in range(len(keys)):
+            selection = order[boundaries[key_id]:boundaries[key_id + 1]]
+            rows = entry_rows[selection]
+            col_values = entry_values[selection]
+            if key_id in set_keys:
+                # rows with an empty set are marked with value -1
+                present_rows, counts = np.unique(rows, return_counts=True)
+                counts -= np.bincount(rows[col_values < 0], minlength=n_rows)[present_rows]
+                offsets = np.zeros(len(present_rows) + 1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[1:])
+                columns.append(Column(True, present_rows.astype(np.int32), col_values[col_values >= 0].astype(np.int32), offsets))
+            else:
+                columns.append(Column(False, rows, col_values.astype(np.int32)))
+
+        return DependencyTable(n_rows, list(keys), list(values), columns)
+
+    @staticmethod
+    def from_dicts(deps):
+        builder = DependencyTableBuilder()
+        for dep in deps:
+            builder.add(dep)
+        return builder.build()
+
+
+# Read-only view of a row of a DependencyTable that behaves like a dependency dict
+class TableRow:
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    def _find(self, name):
+        key_id = self.table._key_to_id.get(name, -1)
+        if key_id < 0:
+            return None, -1
+        column = self.table.columns[key_id]
+        return column, column.find(self.i)
+
+    def __contains__(self, name):
+        return self._find(name)[1] >= 0
+
+    def __getitem__(self, name):
+        column, j = self._find(name)
+        if j < 0:
+            raise KeyError(name)
+        values = self.table.values
+        if column.is_set:
+            return set(values[v] for v in column.values[column.offsets[j]:column.offsets[j + 1]])
+        else:
+            return values[column.values[j]]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return [k for k in self.table.keys if k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+# Incrementally encode dependency dicts.
+# Each dependency is stored as a list of (key, value) entries,
+# set features are stored as one entry per element of the set
+# and an empty set is stored as a single entry with value -1.
+# - dep_offsets: entries of dependency i are in [dep_offsets[i], dep_offsets[i+1])
+# - entry_keys, entry_values: ids of keys and values of each entry
+# A key must have the same type (str or set) in all dependencies.
+class DependencyTableBuilder:
+    def __init__(self):
+        self.keys = dict()
+        self.scalar_keys = set()
+        self.set_keys = set()
+        self.values = dict()
+        self.dep_offsets = array.array("q", [0])
+        self.entry_keys = array.array("i")
+        self.entry_values = array.array("i")
+
+    def __len__(self):
+        return len(self.dep_offsets) - 1
+
+    def add(self, dep):
+        for k, v in dep.items():
+            key_id = self.keys.setdefault(k, len(self.keys))
+            if type(v) == str:
+                if key_id in self.set_keys:
+                    raise RuntimeError("Error in feature types")
+                self.scalar_keys.add(key_id)
+                self.entry_keys.append(key_id)
+                self.entry_values.append(self.values.setdefault(v, len(self.values)))
+            elif type(v) == set:
+                if key_id in self.scalar_keys:
+                    raise RuntimeError("Error in feature types")
+                self.set_keys.add(key_id)
+                if len(v) == 0:
+                    self.entry_keys.append(key_id)
+                    self.entry_values.append(-1)
+                for e in v:
+                    self.entry_keys.append(key_id)
+                    self.entry_values.append(self.values.setdefault(e, len(self.values)))
+            else:
+                raise RuntimeError("Unusable data type for feature %s: %s" % (k, type(v)))
+        self.dep_offsets.append(len(self.entry_keys))
+
+    def build(self):
+        return DependencyTable.from_entries(
+            np.frombuffer(self.dep_offsets, dtype=np.int64),
+            np.frombuffer(self.entry_keys, dtype=np.int32),
+            np.frombuffer(self.entry_values, dtype=np.int32),
+            list(self.keys.keys()),
+            self.set_keys,
+            list(self.values.keys())
+        )
+
+
+# Save a table in a directory:
+# arrays of all columns are concatenated and stored as .npy files so they can be memory-mapped,
+# column k uses rows[row_offsets[k]:row_offsets[k+1]], values[value_offsets[k]:value_offsets[k+1]]
+# and, for set features, set_offsets[set_offset_offsets[k]:set_offset_offsets[k+1]].
+# vocab.json contains the number of rows, the string of each key and value id, and keys of set features.
+def save_table(table, directory):
+    def concatenate(arrays, dtype):
+        boundaries = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=boundaries[1:])
+        data = np.concatenate(arrays).astype(dtype) if len(arrays) > 0 else np.zeros(0, dtype=dtype)
+        return data, boundaries
+
+    rows, row_offsets = concatenate([c.rows for c in table.columns], np.int32)
+    values, value_offsets = concatenate([c.values for c in table.columns], np.int32)
+    set_offsets, set_offset_offsets = concatenate(
+        [c.offsets if c.is_set else np.zeros(0, dtype=np.int64) for c in table.columns],
+        np.int64
+    )
+
+    os.makedirs(directory)
+    for name, array in [
+        ("rows", rows), ("row_offsets", row_offsets),
+        ("values", values), ("value_offsets", value_offsets),
+        ("set_offsets", set_offsets), ("set_offset_offsets", set_offset_offsets)
+    ]:
+        np.save(os.path.join(directory, "%s.npy" % name), array)
+    with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as ostream:
+        json.dump({
+            "n_rows": table.n_rows,
+            "keys": table.keys,
+            "set_keys": [k for k, c in enumerate(table.columns) if c.is_set],
+            "values": table.values
+        }, ostream)
+
+
+# columns are views of the memory-mapped arrays
+def load_table(directory):
+    with open(os.path.join(directory, "vocab.json"), encoding="utf-8") as istream:
+        vocab = json.load(istream)
+    arrays = {
+        name: np.load(os.path.join(directory, "%s.npy" % name), mmap_mode="r")
+        for name in ["rows", "row_offsets", "values", "value_offsets", "set_offsets", "set_offset_offsets"]
+    }
+    row_offsets = arrays["row_offsets"].tolist()
+    value_offsets = arrays["value_offsets"].tolist()
+    set_offset_offsets = arrays["set_offset_offsets"].tolist()
+    set_keys = set(vocab["set_keys"])
+
+    columns = list()
+    for k in range(len(vocab["keys"])):
+        rows = arrays["rows"][row_offsets[k]:row_offsets[k + 1]]
+        values = arrays["values"][value_offsets[k]:value_offsets[k + 1]]
+        if k in set_keys:
+            offsets = arrays["set_offsets"][set_offset_offsets[k]:set_offset_offsets[k + 1]]
+            columns.append(Column(True, rows, values, offsets))
+        else:
+            columns.append(Column(False, rows, values))
+
+    return DependencyTable(vocab["n_rows"], vocab["keys"], vocab["values"], columns)
+
+
+def as_table(data):
+    if isinstance(data, DependencyTable):
+        return data
+    return DependencyTable.from_dicts(data)
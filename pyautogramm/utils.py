@@ -1,6 +1,7 @@
 class Dict:
     def __init__(self, values):
-        values = set(values)
+        # sorted so that ids do not depend on the hash seed
+        values = sorted(set(values))
         self._id_to_str = list()
         self._str_to_id = dict()
 